@@ -1,16 +1,40 @@
 import os
+import logging
+import importlib.util
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
 from dotenv import load_dotenv
 from source.routers import router as text2image_router
+from source import registry
+from source.metrics import InFlightMiddleware
+from source.context import RequestContextMiddleware, RequestIdFilter
 
 # 加载环境变量
 load_dotenv()
 LOCAL_SERVER_URL = os.getenv("LOCAL_SERVER_URL", "http://127.0.0.1:11002")
 
+# 日志中带上请求ID，便于按请求排查
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s [%(request_id)s] %(message)s"
+)
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
+
+
+# 应用生命周期：启动时创建共享的客户端和连接池，关闭时统一释放
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await registry.startup()
+    yield
+    # 收到 SIGTERM 后 uvicorn 先停止接收新连接并等待进行中的请求结束，再等待后台任务完成
+    await registry.shutdown(drain_timeout=float(os.getenv("JOB_DRAIN_TIMEOUT", 30)))
+
+
 # 创建FastAPI应用
 app = FastAPI(
     title="AIGC 图像生成 API",
@@ -34,6 +58,7 @@ app = FastAPI(
     docs_url=None,  # 禁用默认的 docs 路径，我们将自定义它
     redoc_url="/redoc",
     openapi_url="/openapi.json",
+    lifespan=lifespan,
 )
 
 # 添加CORS中间件
@@ -45,6 +70,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 统计进行中的请求数
+app.add_middleware(InFlightMiddleware)
+
+# 为每个请求生成请求ID并记录各阶段耗时
+app.add_middleware(RequestContextMiddleware)
+
 # 包含路由
 app.include_router(text2image_router)
 
@@ -103,11 +134,43 @@ async def custom_swagger_ui_html():
         swagger_favicon_url="/favicon.ico",
     )
 
+def _pick_implementation(module_name, fallback):
+    # uvloop / httptools 为可选依赖，未安装时回退到标准实现
+    return module_name if importlib.util.find_spec(module_name) else fallback
+
+
+def run_production_server(host, port):
+    """
+    以生产模式启动：不监听代码变化，worker 进程数由 SERVER_WORKERS 指定，默认为 1
+
+    异步任务、限流和调度都在进程内维护，多个 worker 时任务只能在提交它的进程上查询、
+    限流额度按进程数成倍放大，因此需要显式配置 SERVER_WORKERS 才会启动多个进程
+
+    收到 SIGTERM 后停止接收新连接，最多等待 SERVER_GRACEFUL_SHUTDOWN_TIMEOUT 秒让进行中的请求完成，
+    再最多等待 JOB_DRAIN_TIMEOUT 秒让异步任务完成，滚动发布时不会中断正在生成的图片
+    """
+    uvicorn.run(
+        "main:app",
+        host=host,
+        port=port,
+        workers=int(os.getenv("SERVER_WORKERS", 1)),
+        loop=_pick_implementation("uvloop", "asyncio"),
+        http=_pick_implementation("httptools", "h11"),
+        timeout_keep_alive=int(os.getenv("SERVER_KEEP_ALIVE_TIMEOUT", 75)),
+        timeout_graceful_shutdown=int(os.getenv("SERVER_GRACEFUL_SHUTDOWN_TIMEOUT", 60)),
+        proxy_headers=True,
+    )
+
+
 # 启动服务器
 if __name__ == "__main__":
     # 从LOCAL_SERVER_URL解析主机和端口
     parts = LOCAL_SERVER_URL.split(":")
-    host = parts[1].strip("/")
+    host = os.getenv("SERVER_HOST") or parts[1].strip("/")
     port = int(parts[2]) if len(parts) > 2 else 11002
     
-    uvicorn.run("main:app", host=host, port=port, reload=True)
\ No newline at end of file
+    # SERVER_MODE=production 时使用多进程生产模式，默认为开发模式(代码变化时自动重载)
+    if os.getenv("SERVER_MODE", "development") == "production":
+        run_production_server(host, port)
+    else:
+        uvicorn.run("main:app", host=host, port=port, reload=True)
@@ -1,46 +1,214 @@
 import os
-import base64
-import io
-import boto3
+import re
+import json
+import time
 import uuid
+import random
+import asyncio
+import hashlib
+import functools
 import logging
+import contextvars
+import multiprocessing
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from dotenv import load_dotenv
-from together import Together
+from source.cache import TTLCache
+from source.singleflight import SingleFlight
+from source.uploads import UploadStats, decoded_size
+from source.limiter import UpstreamBusyError, parse_retry_after
+from source.upstreams import UpstreamPool
+from source.hedging import Hedger
+from source.metrics import STAGE_DURATION, GENERATIONS_IN_FLIGHT, IMAGES_TOTAL, UPSTREAM_ERRORS, OPTIMIZER_BATCH_SIZE
+from source.batching import MicroBatcher
+from source.variants import VARIANT_FORMATS, supported_formats, encode_variants
+from source.storage import create_storage
+from source.references import ReferenceImageCache, parse_reference_image, to_data_url
+from source.scheduler import ModelSchedulers
+from source.quality import QualityLadder
+from source.context import record_timing, deadline_after, current_tenant
+
+# 提示词优化使用的系统提示，修改后缓存键随之变化，旧的缓存自动失效
+OPTIMIZE_SYSTEM_PROMPT = "你是一个专业的提示词优化助手，专门为FLUX图像生成模型优化提示词。你的任务是将用户输入的任何语言的提示词转换为高质量、详细的英文提示词。请添加丰富的视觉细节，包括光照效果、材质描述、视角、风格、色彩方案等。使用FLUX模型喜欢的关键词和格式，如'highly detailed'、'4k resolution'、'masterpiece'等增强词。确保最终提示词既保留原始意图，又能最大化FLUX模型的生成效果。请直接返回纯文本格式的提示词，不要包含任何JSON结构、大括号{}、中括号[]、反引号`，也不要在回复中包含'prompt'这个词。"
+# 批量优化时追加到系统提示后的格式说明
+OPTIMIZE_BATCH_INSTRUCTION = "用户会一次提供多条提示词，每条以单独一行的'### 编号'开头。请分别优化每一条，按原编号顺序输出，每条结果同样以单独一行的'### 编号'开头，下一行紧跟该条优化后的英文提示词，不要合并、遗漏或添加其他说明。"
 
 
 class ImageGenerator:
-    def __init__(self):
+    def __init__(self, togetherai_client=None, storage=None):
+        """
+        参数:
+            togetherai_client: Together 客户端或客户端列表，默认按环境变量创建上游池，压测时可以传入本地替身
+            storage: 图片存储，默认按 STORAGE_BACKEND 创建，压测时可以传入使用本地替身的存储
+        """
         # 加载配置参数文件
         load_dotenv()
         # 检查必要的环境变量是否存在
         self._check_environment_variables()
-        self.api_key = os.getenv("TOGETHER_API_KEY")
         self.model = os.getenv("TOGETHER_MODEL")
-        self.togetherai_client = Together(api_key=self.api_key)
-        self.s3_client = self._init_s3_client()
+
+        # 图片保存到 STORAGE_BACKEND 指定的存储(s3 / local / write_back)，
+        # 保存使用独立的有界线程池，与 S3 客户端连接池大小一致
+        self.upload_workers = int(os.getenv("S3_UPLOAD_WORKERS", 8))
+        self.storage = storage or create_storage(
+            max_pool_connections=self.upload_workers,
+            multipart_threshold=int(os.getenv("S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+        )
+        self.upload_executor = ThreadPoolExecutor(
+            max_workers=self.upload_workers,
+            thread_name_prefix="image-upload"
+        )
+        self.upload_stats = UploadStats()
+
+        # 可选的图片变体：原图转码为 IMAGE_VARIANT_FORMATS 中的格式并按 IMAGE_THUMBNAIL_SIZES 生成缩略图，
+        # 编码是 CPU 密集型操作，放在独立的进程池中执行，不占用事件循环和线程池
+        self.variant_formats = supported_formats(
+            [name.strip().lower() for name in os.getenv("IMAGE_VARIANT_FORMATS", "").split(",") if name.strip()]
+        )
+        self.thumbnail_sizes = [int(size) for size in os.getenv("IMAGE_THUMBNAIL_SIZES", "").split(",") if size.strip()]
+        self.thumbnail_format = None
+        if self.thumbnail_sizes:
+            thumbnail_formats = supported_formats([os.getenv("IMAGE_THUMBNAIL_FORMAT", "webp").lower()])
+            self.thumbnail_format = thumbnail_formats[0] if thumbnail_formats else None
+            if self.thumbnail_format is None:
+                self.thumbnail_sizes = []
+        self.variant_quality = int(os.getenv("IMAGE_VARIANT_QUALITY", 80))
+        self.variant_executor = None
+        if self.variant_formats or self.thumbnail_sizes:
+            # 使用 spawn 启动子进程，避免 fork 时复制已经持有锁的线程状态
+            self.variant_executor = ProcessPoolExecutor(
+                max_workers=int(os.getenv("IMAGE_VARIANT_WORKERS", os.cpu_count() or 1)),
+                mp_context=multiprocessing.get_context("spawn")
+            )
 
         self.max_image_count = int(os.getenv("MAX_IMAGE_COUNT", 6))
 
+        # Together / boto3 / requests 都是同步客户端，统一放到有界线程池中执行，避免阻塞事件循环
+        self.executor_max_workers = int(os.getenv("EXECUTOR_MAX_WORKERS", 32))
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.executor_max_workers,
+            thread_name_prefix="image-generator"
+        )
+        # 单个请求内同时进行的生成/上传数量上限
+        self.image_concurrency = int(os.getenv("IMAGE_CONCURRENCY", 3))
+        # 批量接口中同时进行的生成请求数，由所有批量请求共享，避免批量任务挤占在线请求
+        self.batch_concurrency = int(os.getenv("BATCH_CONCURRENCY", 4))
+        self.batch_semaphore = asyncio.Semaphore(self.batch_concurrency)
+        self.batch_max_items = int(os.getenv("BATCH_MAX_ITEMS", 200))
+
+        # 提示词优化结果缓存，PROMPT_CACHE_SIZE 为 0 时关闭
+        self.prompt_cache = TTLCache(
+            max_size=int(os.getenv("PROMPT_CACHE_SIZE", 1000)),
+            ttl=int(os.getenv("PROMPT_CACHE_TTL", 86400)),
+            persist_path=os.getenv("PROMPT_CACHE_PATH") or None
+        )
+        # 生成结果缓存，保存相同生成参数对应的图片URL，RESULT_CACHE_SIZE 为 0 时关闭
+        self.result_cache = TTLCache(
+            max_size=int(os.getenv("RESULT_CACHE_SIZE", 500)),
+            ttl=int(os.getenv("RESULT_CACHE_TTL", 3600)),
+            persist_path=os.getenv("RESULT_CACHE_PATH") or None
+        )
+        # 提示词优化使用长连接池，避免每次请求都重新建立 TCP/TLS 连接
+        self.optimizer_connect_timeout = float(os.getenv("OPTIMIZER_CONNECT_TIMEOUT", 3))
+        self.optimizer_read_timeout = float(os.getenv("OPTIMIZER_READ_TIMEOUT", 15))
+        self.optimizer_deadline = float(os.getenv("OPTIMIZER_DEADLINE", 20))
+        self.optimizer_backoff_base = float(os.getenv("OPTIMIZER_BACKOFF_BASE", 0.5))
+        self.optimizer_backoff_max = float(os.getenv("OPTIMIZER_BACKOFF_MAX", 8))
+        self.optimizer_session = self._init_optimizer_session()
+        # 图生图的参考图：请求中上传的图片直接在内存中使用，远程图片按 URL 缓存，
+        # 总大小不超过 REFERENCE_CACHE_BYTES，单张不超过 REFERENCE_MAX_BYTES
+        self.reference_max_bytes = int(os.getenv("REFERENCE_MAX_BYTES", 10 * 1024 * 1024))
+        self.reference_cache = ReferenceImageCache(
+            self.optimizer_session,
+            max_bytes=int(os.getenv("REFERENCE_CACHE_BYTES", 256 * 1024 * 1024)),
+            max_image_bytes=self.reference_max_bytes,
+            fresh_ttl=float(os.getenv("REFERENCE_CACHE_TTL", 300)),
+            timeout=(self.optimizer_connect_timeout, float(os.getenv("REFERENCE_READ_TIMEOUT", 15))),
+            allowed_hosts=[host.strip() for host in os.getenv("REFERENCE_ALLOWED_HOSTS", "").split(",") if host.strip()]
+        )
+        # 多条提示词合并为一次调用；并发的单条优化请求在 OPTIMIZER_BATCH_WINDOW 秒内自动合并
+        self.optimizer_batch_size = max(1, int(os.getenv("OPTIMIZER_BATCH_SIZE", 8)))
+        self.optimizer_batch_window = float(os.getenv("OPTIMIZER_BATCH_WINDOW", 0.02))
+        self.optimizer_batch_max_tokens = int(os.getenv("OPTIMIZER_BATCH_MAX_TOKENS", 4000))
+        self.prompt_batcher = None
+        if self.optimizer_batch_size > 1 and self.optimizer_batch_window > 0:
+            # 合并后的调用由多个请求共享，截止时间取其中最晚的一个
+            self.prompt_batcher = MicroBatcher(
+                lambda prompts: self._run_blocking(self._optimize_uncached, prompts),
+                max_size=self.optimizer_batch_size,
+                window=self.optimizer_batch_window
+            )
+
+        # Together 上游池：可以配置多个 API Key / 服务地址，每个上游按模型单独限流并带有熔断器，
+        # 上游 429 后暂停该上游 UPSTREAM_COOLDOWN 秒，故障时自动切换到其他上游
+        self.upstream_pool = UpstreamPool.from_env(self._run_blocking, client=togetherai_client)
+        # 生成调用的加权公平调度：每个模型单独按租户公平排队，interactive 优先于 batch，
+        # 并发数默认等于支持该模型的上游对该模型的并发数之和，使排队发生在调度器而不是上游限流器中
+        self.scheduler = ModelSchedulers.from_env(capacity_for=self.upstream_pool.capacity)
+        # 按排队比例与上游耗时逐级降低步数、分辨率和图片数量，负载下降后逐级恢复
+        self.quality_ladder = QualityLadder.from_env()
+        # 对冲请求：生成调用超过该模型耗时的 HEDGE_PERCENTILE 分位数仍未返回时，
+        # 在另一个上游上再发起一次，对冲请求数不超过正常请求的 HEDGE_BUDGET 倍
+        self.hedger = Hedger(
+            percentile=float(os.getenv("HEDGE_PERCENTILE", 0)),
+            budget_ratio=float(os.getenv("HEDGE_BUDGET", 0.1)),
+            min_delay=float(os.getenv("HEDGE_MIN_DELAY", 1.0)),
+            window=int(os.getenv("HEDGE_WINDOW", 500)),
+            min_samples=int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+        )
+
+        # 合并相同参数的并发优化/生成请求，只向上游发起一次调用
+        self.optimize_flight = SingleFlight()
+        self.generate_flight = SingleFlight()
+        self.reference_flight = SingleFlight()
+
     def _check_environment_variables(self):
-        required_env_vars = [
-            "S3_ENDPOINT_URL", 
-            "S3_ACCESS_KEY_ID",
-            "S3_SECRET_ACCESS_KEY", 
-            "S3_BUCKET_NAME",
-            "TOGETHER_MODEL",
-            "TOGETHER_API_KEY"
-        ]
+        # S3 相关的环境变量只在使用 S3 存储时检查
+        # 配置了 TOGETHER_UPSTREAMS / TOGETHER_API_KEYS 时不需要 TOGETHER_API_KEY
+        required_env_vars = ["TOGETHER_MODEL"]
+        if not os.getenv("TOGETHER_UPSTREAMS") and not os.getenv("TOGETHER_API_KEYS"):
+            required_env_vars.append("TOGETHER_API_KEY")
         missing_vars = [var for var in required_env_vars if not os.getenv(var)]
         if missing_vars:
             raise EnvironmentError(f"缺少必要的环境变量: {','.join(missing_vars)}")
 
-    def _init_s3_client(self):
-        return boto3.client(
-            "s3",
-            aws_access_key_id=os.getenv("S3_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("S3_SECRET_ACCESS_KEY"),
-            endpoint_url=os.getenv("S3_ENDPOINT_URL")
-        )
+    def close(self):
+        """
+        释放线程池、连接池并保存缓存，应用关闭时调用
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.upload_executor.shutdown(wait=True)
+        self.storage.close()
+        if self.variant_executor is not None:
+            self.variant_executor.shutdown(wait=False, cancel_futures=True)
+        self.optimizer_session.close()
+        self.prompt_cache.save()
+        self.result_cache.save()
+
+    def _init_optimizer_session(self):
+        session = requests.Session()
+        # 连接池大小与线程池一致，保证每个线程都能复用一个长连接
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.executor_max_workers)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    async def _run_blocking(self, func, *args, **kwargs):
+        """
+        在线程池中执行同步调用，并在事件循环中等待其结果
+
+        参数:
+            func (callable): 需要执行的同步函数
+            *args, **kwargs: 传递给函数的参数
+
+        返回:
+            函数的返回值
+        """
+        loop = asyncio.get_running_loop()
+        # run_in_executor 不会传递 contextvars，手动复制以便线程内的日志带上请求ID
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, functools.partial(context.run, func, *args, **kwargs))
 
     def _get_steps(self, model):
         if "FLUX.1-schnell" in model:    # 免费的step最高为4
@@ -48,74 +216,418 @@ class ImageGenerator:
         else:
             return 12
 
-    def _upload_to_s3(self, image_data, folder_name):
-        # 为图片生成唯一的文件名
-        image_name = f"{folder_name}/{uuid.uuid4()}.png"
-        
-        # 直接上传到S3，不需要存储到本地
-        self.s3_client.put_object(
-            Bucket=os.getenv("S3_BUCKET_NAME"),
-            Key=image_name,
-            Body=io.BytesIO(image_data),
-            ACL='public-read',
-            ContentType='image/png'
+    def _queue_ratio(self, model):
+        """该模型排队的生成调用数与并发数之比，关闭调度时使用上游限流器中的排队数"""
+        if self.scheduler.enabled:
+            stats = self.scheduler.for_model(model).stats()
+            return sum(stats["waiting"].values()) / max(1, stats["capacity"])
+        waiting = self.upstream_pool.limiter_stats().get(model, {}).get("waiting", 0)
+        return waiting / max(1, self.upstream_pool.capacity(model))
+
+    def _degrade(self, model, steps, width, height, n):
+        """
+        按当前负载调整生成参数
+
+        返回:
+            tuple: (steps, width, height, n, quality)，未降级时 quality 为 None，
+                否则为实际使用的参数与请求的参数，用于在响应中告知调用方
+        """
+        level = self.quality_ladder.level(model, self._queue_ratio(model), self.upstream_pool.latency(model))
+        if level == 0:
+            return steps, width, height, n, None
+        requested = {"steps": steps, "width": width, "height": height, "count": n}
+        steps, width, height, n = self.quality_ladder.apply(level, steps, width, height, n)
+        applied = {"steps": steps, "width": width, "height": height, "count": n}
+        if applied == requested:
+            return steps, width, height, n, None
+        return steps, width, height, n, {"level": level, **applied, "requested": requested}
+
+    async def _run_upload(self, func, *args, size=0):
+        """
+        在上传线程池中保存图片，并记录排队数与上传耗时
+
+        参数:
+            func (callable): 上传函数，返回图片URL
+            *args: 传递给上传函数的参数
+            size (int): 上传的字节数，用于统计
+
+        返回:
+            str: 图片URL
+        """
+        def upload():
+            self.upload_stats.on_started()
+            start = time.monotonic()
+            try:
+                url = func(*args)
+            except Exception as e:
+                self.upload_stats.on_finished(time.monotonic() - start, success=False)
+                UPSTREAM_ERRORS.inc(upstream="storage", type=type(e).__name__)
+                raise
+            self.upload_stats.on_finished(time.monotonic() - start, size=size)
+            return url
+
+        self.upload_stats.on_queued()
+        future = self.upload_executor.submit(contextvars.copy_context().run, upload)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # 还没开始执行的上传直接取消，不再占用上传线程
+            if future.cancel():
+                self.upload_stats.on_cancelled()
+            raise
+
+    async def _create_variants(self, b64_string, folder_name, image_id):
+        """
+        在进程池中转码并生成缩略图，再与原图上传到同一目录，例如 {image_id}.webp、{image_id}_thumb_256.webp
+
+        返回:
+            dict: 变体名称 -> URL，失败时返回 None，不影响原图
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            with STAGE_DURATION.time(stage="encode"):
+                variants = await loop.run_in_executor(
+                    self.variant_executor,
+                    functools.partial(
+                        encode_variants,
+                        b64_string,
+                        self.variant_formats,
+                        self.thumbnail_sizes,
+                        self.thumbnail_format,
+                        self.variant_quality
+                    )
+                )
+            urls = await asyncio.gather(*[
+                self._run_upload(
+                    self.storage.save,
+                    f"{folder_name}/{image_id}.{extension}" if name in VARIANT_FORMATS else f"{folder_name}/{image_id}_{name}.{extension}",
+                    data,
+                    content_type,
+                    size=len(data)
+                )
+                for name, extension, content_type, data in variants
+            ])
+        except Exception as e:
+            logging.warning(f"生成图片变体失败: {str(e)}")
+            return None
+        return {variant[0]: url for variant, url in zip(variants, urls)}
+
+    def _emit(self, on_event, event_type, **payload):
+        """
+        向调用方回调生成过程中的阶段事件，回调异常不影响生成流程
+        """
+        if on_event is None:
+            return
+        try:
+            on_event({"type": event_type, **payload})
+        except Exception as e:
+            logging.warning(f"事件回调失败: {str(e)}")
+
+    async def _generate_single_image(self, index, params, semaphore, on_event=None, priority="interactive"):
+        """
+        生成并上传单张图片，失败时返回错误信息而不是抛出异常
+
+        参数:
+            index (int): 图片在本次请求中的序号
+            params (dict): 生成参数，包含 prompt、model、width、height、steps、seed
+            semaphore (asyncio.Semaphore): 单个请求内的并发上限
+            on_event (callable): 阶段事件回调，可选
+            priority (str): 调度优先级 interactive / batch
+
+        返回:
+            dict: 包含 index、url、error 的结果
+        """
+        generate_kwargs = {}
+        if params["seed"] is not None:
+            # 每张图片使用不同的种子，否则同一请求内的图片会完全相同
+            generate_kwargs["seed"] = params["seed"] + index
+
+        async with semaphore:
+            timings = {}
+            try:
+                # 排队时回调 queued 事件，position 为前面还有多少个生成调用
+                queued_at = time.perf_counter()
+                async with self.scheduler.slot(
+                    params["model"],
+                    current_tenant(),
+                    priority,
+                    on_position=lambda position: self._emit(on_event, "queued", index=index, position=position)
+                ):
+                    started_at = time.perf_counter()
+                    if self.scheduler.enabled:
+                        timings["queue"] = started_at - queued_at
+                    response = await self._call_upstream(
+                        params["model"],
+                        "generate",
+                        prompt=f"[{params['prompt']}]",
+                        model=params["model"],
+                        width=params["width"],
+                        height=params["height"],
+                        steps=params["steps"],
+                        n=1,
+                        response_format="b64_json",
+                        **generate_kwargs
+                    )
+
+                timings["generate"] = time.perf_counter() - started_at
+                self._emit(on_event, "image_generated", index=index)
+
+                async def timed(stage, coroutine):
+                    started_at = time.perf_counter()
+                    try:
+                        return await coroutine
+                    finally:
+                        timings[stage] = time.perf_counter() - started_at
+
+                # 保存图片并获取URL，base64 解码在上传线程中进行；开启图片变体时转码与原图上传同时进行
+                b64_json = response.data[0].b64_json
+                image_id = uuid.uuid4()
+                upload = timed("upload", self._run_upload(
+                    self.storage.save_b64, f"output_text2image/{image_id}.png", b64_json,
+                    size=decoded_size(b64_json)
+                ))
+                if self.variant_executor is None:
+                    s3_url, variants = await upload, None
+                else:
+                    s3_url, variants = await asyncio.gather(
+                        upload,
+                        timed("variants", self._create_variants(b64_json, "output_text2image", image_id))
+                    )
+                print(f"图片已保存，URL为：{s3_url}")
+                self._emit(on_event, "image_uploaded", index=index, url=s3_url, variants=variants)
+                IMAGES_TOTAL.inc(status="success")
+                return {"index": index, "url": s3_url, "error": None, "variants": variants, "timings": timings}
+            except UpstreamBusyError as e:
+                logging.warning(f"第 {index + 1} 张图片生成被限流: {str(e)}")
+                self._emit(on_event, "image_failed", index=index, error=str(e))
+                IMAGES_TOTAL.inc(status="failed")
+                return {"index": index, "url": None, "error": str(e), "retry_after": e.retry_after, "timings": timings}
+            except Exception as e:
+                logging.error(f"第 {index + 1} 张图片生成失败: {str(e)}")
+                self._emit(on_event, "image_failed", index=index, error=str(e))
+                IMAGES_TOTAL.inc(status="failed")
+                return {"index": index, "url": None, "error": str(e), "timings": timings}
+
+    async def _call_upstream(self, upstream_model, operation, allow_hedge=True, **kwargs):
+        """
+        经过上游池调用 Together 的 images.<operation>，上游故障或被限流时自动切换上游，
+        所有上游都被限流或熔断时抛出 UpstreamBusyError；开启对冲且 allow_hedge 为 True 时调用可能同时发给两个上游
+        """
+        if not allow_hedge or not self.hedger.enabled:
+            return await self.upstream_pool.call(upstream_model, operation, **kwargs)
+        # 正常请求与对冲请求共用 used，对冲请求尽量选择另一个上游
+        used = []
+        return await self.hedger.run(
+            upstream_model,
+            lambda hedge, on_dispatch: self.upstream_pool.call(
+                upstream_model, operation, used=used, on_dispatch=on_dispatch, **kwargs
+            )
         )
-        
-        # 生成URL并返回
-        s3_url = f"{os.getenv('S3_ENDPOINT_URL')}/{os.getenv('S3_BUCKET_NAME')}/{image_name}"
-        return s3_url
 
-    async def text2image(self, 
+    def _result_cache_key(self, params, n):
+        raw = json.dumps({**params, "n": n}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def generate_images(self, 
                         prompt: str, 
                         generate_steps: int = None,
                         model: str = None,
                         output_size_width: int = 1024, 
                         output_size_height: int = 1024, 
                         n: int = 1,
-                        need_optimize_prompt: bool = True):
-        
-        if not model:
-            model = self.model  
+                        need_optimize_prompt: bool = True,
+                        seed: int = None,
+                        use_cache: bool = True,
+                        on_event=None,
+                        priority: str = None):
+        """
+        并发生成n张图片，单张失败不会影响其他图片
 
-        if generate_steps:
-            steps = generate_steps
-        else:
-            steps = self._get_steps(model)
+        参数:
+            seed (int): 随机种子，第 i 张图片使用 seed + i；为空时由上游随机生成
+            use_cache (bool): 是否使用生成结果缓存，为 False 时强制重新生成；未指定 seed 时每次都重新生成，不读写缓存
+            on_event (callable): 阶段事件回调，接收包含 type 字段的字典，
+                依次为 started、prompt_optimized、queued(排队时)、image_generated、image_uploaded / image_failed；
+                负载较高而降低生成质量时，started 事件的 quality 为实际使用的参数
+            priority (str): 调度优先级 interactive(默认) / batch，按当前请求的租户公平排队
 
-        if need_optimize_prompt:
-            prompt = self.optimize_prompt(prompt)
-        # 创建一个列表来存储所有生成的图片URL
-        s3_urls = []
+        返回:
+            list: 按序号排列的结果列表，每项包含 index、url、error，命中缓存时额外包含 cached
+        """
+        with GENERATIONS_IN_FLIGHT.track():
+            if not model:
+                model = self.model  
 
-        if n > self.max_image_count:   
-            n = self.max_image_count
-            print(f"您生成的图片数量超过最大限制，已自动调整为最大限制: {n}")
-        # 循环生成n张图片
-        for _ in range(n):
-            response = self.togetherai_client.images.generate(
-                prompt=f"[{prompt}]",
-                model=model,
-                width=output_size_width,
-                height=output_size_height,
-                steps=steps,
-                n=1,
-                response_format="b64_json"
+            if generate_steps:
+                steps = generate_steps
+            else:
+                steps = self._get_steps(model)
+
+            if n > self.max_image_count:   
+                n = self.max_image_count
+                print(f"您生成的图片数量超过最大限制，已自动调整为最大限制: {n}")
+            # 负载较高时降低步数、分辨率和图片数量，started 事件中的 quality 给出实际使用的参数
+            steps, output_size_width, output_size_height, n, quality = self._degrade(
+                model, steps, output_size_width, output_size_height, n
             )
-            
-            # 处理生成的图片
-            for i in range(len(response.data)):
-                # 将base64字符串解码为图片数据
-                image_data = base64.b64decode(response.data[i].b64_json)
-                
-                # 上传到S3并获取URL
-                s3_url = self._upload_to_s3(image_data, "output_text2image")
-                print(f"图片已上传到S3，URL为：{s3_url}")
-                s3_urls.append(s3_url)
+            self._emit(on_event, "started", total=n, quality=quality)
+
+            if need_optimize_prompt:
+                raw_prompt = prompt
+                started_at = time.perf_counter()
+                prompt = await self.optimize_flight.do(
+                    self._prompt_cache_key(raw_prompt),
+                    lambda _: self._optimize_prompt_async(raw_prompt)
+                )
+                optimize_seconds = time.perf_counter() - started_at
+                STAGE_DURATION.observe(optimize_seconds, stage="optimize")
+                record_timing("optimize", optimize_seconds)
+                self._emit(on_event, "prompt_optimized", prompt=prompt)
+
+            params = {
+                "prompt": prompt,
+                "model": model,
+                "width": output_size_width,
+                "height": output_size_height,
+                "steps": steps,
+                "seed": seed,
+            }
+
+            # 指定了 seed 且参数相同的请求直接返回之前上传的图片；
+            # 未指定 seed 时每次请求都应得到新的图片，不使用缓存
+            cache_key = self._result_cache_key(params, n)
+            if use_cache and seed is not None:
+                cached_images = self.result_cache.get(cache_key)
+                if cached_images is not None:
+                    print(f"生成结果命中缓存: {prompt}")
+                    results = []
+                    for i, cached_image in enumerate(cached_images):
+                        # 旧版本的缓存只保存了URL
+                        if isinstance(cached_image, str):
+                            cached_image = {"url": cached_image}
+                        url, variants = cached_image["url"], cached_image.get("variants")
+                        self._emit(on_event, "image_uploaded", index=i, url=url, variants=variants)
+                        IMAGES_TOTAL.inc(status="cached")
+                        results.append({"index": i, "url": url, "error": None, "variants": variants, "cached": True})
+                    return results
+
+            # 相同参数的并发请求共享同一次生成，后加入的调用方只能收到加入之后的事件；
+            # 共享的生成按所有调用方中最晚的截止时间进行，所有调用方都离开后才会被取消
+            return await self.generate_flight.do(
+                cache_key,
+                lambda broadcast: self._generate_batch(params, n, cache_key, broadcast, priority or "interactive"),
+                on_event=on_event
+            )
+
+    async def _generate_batch(self, params, n, cache_key, on_event=None, priority="interactive"):
+        # 并发生成n张图片，gather 会保持结果顺序
+        semaphore = asyncio.Semaphore(self.image_concurrency)
+        results = await asyncio.gather(*[
+            self._generate_single_image(i, params, semaphore, on_event, priority)
+            for i in range(n)
+        ])
+
+        # 所有图片都因限流失败时整体返回繁忙，由调用方决定何时重试
+        if results and all("retry_after" in result for result in results):
+            raise UpstreamBusyError(results[0]["error"], retry_after=max(result["retry_after"] for result in results))
+
+        # 只缓存指定了 seed 且全部成功的结果，避免把部分失败固化下来
+        if params.get("seed") is not None and all(result["url"] for result in results):
+            self.result_cache.set(cache_key, [
+                {"url": result["url"], "variants": result.get("variants")} for result in results
+            ])
+        return results
+
+    async def generate_many(self, items, on_event=None):
+        """
+        批量生成多组图片，参数完全相同的条目只生成一次
+
+        所有批量请求共享 BATCH_CONCURRENCY 个并发名额，单组失败不会影响其他组
+
+        参数:
+            items (list): 每项为 generate_images 的关键字参数
+            on_event (callable): 每组完成时回调 item_done 事件，indexes 为使用该组结果的条目序号，
+                quality 与 generate_images 的 started 事件相同，未降低生成质量时为 None
+
+        返回:
+            list: 与 items 一一对应的 (results, error, quality)，成功时 error 为 None
+        """
+        groups = {}
+        for i, params in enumerate(items):
+            key = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+            groups.setdefault(key, []).append(i)
+        self._emit(on_event, "started", total=len(items), unique=len(groups))
+
+        outcomes = [None] * len(items)
+
+        async def run_group(indexes):
+            # 记录该组实际使用的生成参数，负载较高时可能低于请求的参数
+            started = {}
+            async with self.batch_semaphore:
+                try:
+                    results, error = await self.generate_images(
+                        **items[indexes[0]],
+                        on_event=lambda event: started.update(event) if event["type"] == "started" else None
+                    ), None
+                except Exception as e:
+                    results, error = None, e
+            quality = started.get("quality")
+            for i in indexes:
+                outcomes[i] = (results, error, quality)
+            self._emit(on_event, "item_done", indexes=indexes, results=results, error=error, quality=quality)
+
+        await asyncio.gather(*(run_group(indexes) for indexes in groups.values()))
+        return outcomes
+
+    async def text2image(self, 
+                        prompt: str, 
+                        generate_steps: int = None,
+                        model: str = None,
+                        output_size_width: int = 1024, 
+                        output_size_height: int = 1024, 
+                        n: int = 1,
+                        need_optimize_prompt: bool = True,
+                        seed: int = None,
+                        use_cache: bool = True):
+        
+        results = await self.generate_images(
+            prompt=prompt,
+            generate_steps=generate_steps,
+            model=model,
+            output_size_width=output_size_width,
+            output_size_height=output_size_height,
+            n=n,
+            need_optimize_prompt=need_optimize_prompt,
+            seed=seed,
+            use_cache=use_cache
+        )
+        # 创建一个列表来存储所有生成的图片URL
+        s3_urls = [result["url"] for result in results if result["url"]]
+        if results and not s3_urls:
+            raise Exception(results[0]["error"])
         # 返回包含所有URL的列表
         return s3_urls
 
+    async def _load_reference_image(self, image_url=None, reference_image=None):
+        """
+        返回参考图的 base64 字符串
+
+        参数:
+            image_url (str): 远程参考图地址，并发的相同地址只下载一次
+            reference_image (str): 请求中直接上传的 base64 / data URL，优先使用
+        """
+        if reference_image:
+            return parse_reference_image(reference_image, self.reference_max_bytes)
+        if not image_url:
+            raise ValueError("缺少参考图")
+        with STAGE_DURATION.time(stage="reference"):
+            return await self.reference_flight.do(
+                image_url,
+                lambda _: self._run_blocking(self.reference_cache.fetch, image_url)
+            )
+
     async def image2image(self,
-                        image_url: str,
+                        image_url: str = None,
                         prompt: str = "",
                         generate_steps: int = 4,
                         output_size_width: int = 1024,
@@ -123,74 +635,93 @@ class ImageGenerator:
                         model: str = "black-forest-labs/FLUX.1-schnell-Free",
                         n: int = 1,
                         strength: float = 0.8,
-                        need_optimize_prompt: bool = False):
+                        need_optimize_prompt: bool = False,
+                        reference_image: str = None,
+                        priority: str = None,
+                        on_event=None):
         """
         使用Together AI的API进行图生图转换
         
         参数:
-            image_url (str): 输入图像的URL
+            image_url (str): 输入图像的URL，与 reference_image 二选一
             prompt (str): 描述目标图像的文本提示词
             generate_steps (int): 生成步数
             output_size_width (int): 输出图像宽度
             output_size_height (int): 输出图像高度
             model (str): 使用的模型名称
             n (int): 生成图像的数量
-            strength (float): 转换强度，值在0-1之间，越高表示对原图的改变越大
+            strength (float): 转换强度，Together 的 images.generate 不支持该参数，保留只为兼容旧的调用方，不会生效
             need_optimize_prompt (bool): 是否需要优化提示词
+            reference_image (str): 直接上传的输入图像(base64 或 data URL)，不经过存储中转
+            priority (str): 调度优先级 interactive(默认) / batch，一次调用按 n 张图片占用并发
+            on_event (callable): 开始时回调 started 事件，降低生成质量时 quality 为实际使用的参数，可选
             
         返回:
-            list: 生成图像的S3 URL列表
+            list: 生成图像的URL列表
         """
-        import requests
-        
         # 设置steps的数值
         steps = self._get_steps(model)
         
-        # 如果需要优化提示词
-        if need_optimize_prompt and prompt:
-            prompt = self.optimize_prompt(prompt)
-        
-        # 下载输入图像
-        image_response = requests.get(image_url)
-        if image_response.status_code != 200:
-            raise Exception(f"无法下载输入图像: {image_response.status_code}")
+        if n > self.max_image_count:
+            n = self.max_image_count
+        generate_steps, output_size_width, output_size_height, n, quality = self._degrade(
+            model, generate_steps, output_size_width, output_size_height, n
+        )
+        self._emit(on_event, "started", total=n, quality=quality)
         
-        # 将图像转换为base64编码
-        image_base64 = base64.b64encode(image_response.content).decode('utf-8')
+        # 参考图与提示词优化同时进行；远程图像命中缓存时不重新下载和编码
+        reference = asyncio.ensure_future(self._load_reference_image(image_url, reference_image))
+        try:
+            if need_optimize_prompt and prompt:
+                prompt = await self._optimize_prompt_async(prompt)
+            image_base64 = await reference
+        finally:
+            reference.cancel()
         
-        # 调用Together AI的图生图API
-        response = self.togetherai_client.images.edit(
-            image=image_base64,
-            prompt=f"[{prompt}]" if prompt else "",
-            model=model,
-            width=output_size_width,
-            height=output_size_height,
-            steps=generate_steps,
-            n=n,
-            strength=strength,
-            response_format="b64_json"
-        )
+        # Together 没有单独的图生图接口，参考图以 data URL 通过 images.generate 的 image_url 传入；
+        # 一次调用生成 n 张图片，不做对冲
+        async with self.scheduler.slot(model, current_tenant(), priority or "interactive", cost=n):
+            response = await self._call_upstream(
+                model,
+                "generate",
+                allow_hedge=False,
+                image_url=to_data_url(image_base64),
+                prompt=f"[{prompt}]" if prompt else "",
+                model=model,
+                width=output_size_width,
+                height=output_size_height,
+                steps=generate_steps,
+                n=n,
+                response_format="b64_json"
+            )
         
         # 创建一个列表来存储所有生成的图片URL
         s3_urls = []
         
         # 处理每个生成的图片
         for i in range(len(response.data)):
-            # 将base64字符串解码为图片数据
-            image_data = base64.b64decode(response.data[i].b64_json)
-            
-            # 上传到S3并获取URL
-            s3_url = self._upload_to_s3(image_data, "output_image2image")
-            print(f"图生图结果已上传到S3，URL为：{s3_url}")
+            # 保存图片并获取URL，base64 解码在上传线程中进行
+            b64_json = response.data[i].b64_json
+            s3_url = await self._run_upload(
+                self.storage.save_b64, f"output_image2image/{uuid.uuid4()}.png", b64_json, size=decoded_size(b64_json)
+            )
+            print(f"图生图结果已保存，URL为：{s3_url}")
             s3_urls.append(s3_url)
         
         # 返回包含所有URL的列表
         return s3_urls
 
+    def _prompt_cache_key(self, prompt):
+        # 缓存键包含优化模型和系统提示，任何一项变化都不会命中旧结果
+        raw = "\n".join([os.getenv("AZURE_OPENAI_MODEL", ""), OPTIMIZE_SYSTEM_PROMPT, prompt])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
     def optimize_prompt(self, prompt, max_retries=5):
         """
         使用Azure OpenAI API优化提示词，将任何语言的提示词转换为英文格式
         
+        成功的优化结果会写入 prompt_cache，相同的提示词再次请求时直接返回缓存
+        
         参数:
             prompt (str): 用户输入的原始提示词
             max_retries (int): 最大重试次数
@@ -198,10 +729,213 @@ class ImageGenerator:
         返回:
             str: 优化后的英文提示词
         """
-        import requests
-        import json
-        import logging
-        
+        return self.optimize_prompts([prompt], max_retries)[0]
+
+    def optimize_prompts(self, prompts, max_retries=5):
+        """
+        批量优化提示词，未命中缓存的提示词每 OPTIMIZER_BATCH_SIZE 条合并为一次 Azure 调用
+
+        参数:
+            prompts (list): 原始提示词列表
+            max_retries (int): 最大重试次数
+
+        返回:
+            list: 与 prompts 对应的优化结果，优化失败的条目为原始提示词
+        """
+        results = []
+        missing = []
+        for prompt in prompts:
+            cached_prompt = self.prompt_cache.get(self._prompt_cache_key(prompt))
+            if cached_prompt is not None:
+                print(f"提示词优化命中缓存: {prompt}")
+            else:
+                missing.append(prompt)
+            results.append(cached_prompt)
+
+        if missing:
+            optimized = iter(self._optimize_uncached(missing, max_retries))
+            results = [result if result is not None else next(optimized) for result in results]
+        return results
+
+    async def _optimize_prompt_async(self, prompt):
+        """
+        在事件循环中优化单条提示词，未命中缓存时交给微批处理器与其他并发请求合并为一次调用
+
+        requests 的读取超时只限制单次读取，响应缓慢地持续返回时可能超过时间预算，
+        因此整体等待不超过 OPTIMIZER_DEADLINE 秒(且不晚于请求的截止时间)，超时后返回原始提示词
+        """
+        cached_prompt = self.prompt_cache.get(self._prompt_cache_key(prompt))
+        if cached_prompt is not None:
+            print(f"提示词优化命中缓存: {prompt}")
+            return cached_prompt
+        if self.prompt_batcher is None:
+            optimization = self._optimize_single_async(prompt)
+        else:
+            optimization = self.prompt_batcher.submit(prompt)
+        timeout = max(0.0, deadline_after(self.optimizer_deadline) - time.monotonic())
+        try:
+            return await asyncio.wait_for(optimization, timeout=timeout)
+        except asyncio.TimeoutError:
+            # 线程中的调用无法中断，完成后仍会写入缓存
+            logging.warning(f"提示词优化超过 {self.optimizer_deadline} 秒的时间预算，返回原始提示词")
+            return prompt
+
+    async def _optimize_single_async(self, prompt):
+        return (await self._run_blocking(self._optimize_uncached, [prompt]))[0]
+
+    def _optimize_uncached(self, prompts, max_retries=5):
+        """
+        优化未命中缓存的提示词，成功的结果写入 prompt_cache
+
+        返回:
+            list: 与 prompts 对应的优化结果，优化失败时返回原始提示词，且不写入缓存，下次请求仍会重新优化
+        """
+        unique_prompts = list(dict.fromkeys(prompts))
+        optimized = {}
+        for start in range(0, len(unique_prompts), self.optimizer_batch_size):
+            chunk = unique_prompts[start:start + self.optimizer_batch_size]
+            OPTIMIZER_BATCH_SIZE.observe(len(chunk))
+            if len(chunk) == 1:
+                chunk_results = [self._request_optimized_prompt(chunk[0], max_retries)]
+            else:
+                chunk_results = self._request_optimized_prompts(chunk, max_retries)
+            for prompt, optimized_prompt in zip(chunk, chunk_results):
+                if optimized_prompt is not None:
+                    self.prompt_cache.set(self._prompt_cache_key(prompt), optimized_prompt)
+                optimized[prompt] = optimized_prompt
+        return [optimized[prompt] if optimized[prompt] is not None else prompt for prompt in prompts]
+
+    def _optimizer_request_data(self, system_prompt, user_content, max_tokens):
+        return {
+            "messages": [
+                {
+                    "role": "system",
+                    "content": system_prompt
+                },
+                {
+                    "role": "user",
+                    "content": user_content
+                }
+            ],
+            "temperature": 0.8,
+            "max_tokens": max_tokens,
+            "top_p": 0.95,
+            "response_format": { "type": "text" }
+        }
+
+    def _request_optimized_prompt(self, prompt, max_retries=5, deadline=None):
+        """
+        调用Azure OpenAI API优化提示词
+
+        返回内容不符合格式要求时在系统提示中追加提醒后重试
+
+        参数:
+            deadline (float): time.monotonic() 表示的截止时间，默认为 OPTIMIZER_DEADLINE 秒之后，且不晚于当前请求的截止时间
+
+        返回:
+            str: 优化后的英文提示词，失败、超时或触发内容审查时返回 None
+        """
+        data = self._optimizer_request_data(
+            OPTIMIZE_SYSTEM_PROMPT,
+            f"请将以下提示词转换为高质量的英文提示词，用于FLUX AI图像生成模型。添加必要的视觉细节、风格描述和技术参数，但保持原始概念不变。直接返回纯文本格式的提示词，不要包含任何JSON结构或标记：\n\n{prompt}",
+            500
+        )
+        deadline = deadline or deadline_after(self.optimizer_deadline)
+        for retry_count in range(max_retries):
+            optimized_prompt, filtered = self._post_chat_completion(data, deadline, max_retries)
+            if filtered:
+                print(f"您生成的内容不符合内容审查的规范，请重新使用合适的提示词")
+                logging.warning(f"您生成的内容不符合内容审查的规范，请重新使用合适的提示词: {prompt}")
+                return None
+            if optimized_prompt is None:
+                return None
+
+            # 验证返回的提示词格式
+            problem = _validate_optimized_prompt(optimized_prompt)
+            if problem is not None:
+                message, reminder = problem
+                logging.warning(f"{message}，重试 {retry_count + 1}/{max_retries}")
+                if reminder not in data["messages"][0]["content"]:
+                    data["messages"][0]["content"] += reminder
+                continue
+
+            print(f"原始提示词: {prompt}")
+            print(f"优化后提示词: {optimized_prompt}")
+            return optimized_prompt
+
+        # 如果所有尝试都失败，返回 None，由调用方使用原始提示词
+        logging.warning(f"达到最大重试次数，返回原始提示词")
+        return None
+
+    def _request_optimized_prompts(self, prompts, max_retries=5):
+        """
+        在一次Azure OpenAI调用中优化多条提示词
+
+        每条提示词以单独一行的 "### 编号" 开头，要求返回相同格式；缺失或不符合格式要求的条目
+        单独组成下一批重试。整批触发内容审查时逐条重新优化，只有被审查的那条返回 None
+
+        返回:
+            list: 与 prompts 对应的优化结果，失败的条目为 None
+        """
+        results = [None] * len(prompts)
+        pending = list(range(len(prompts)))
+        system_prompt = OPTIMIZE_SYSTEM_PROMPT + OPTIMIZE_BATCH_INSTRUCTION
+        deadline = deadline_after(self.optimizer_deadline)
+        for retry_count in range(max_retries):
+            if len(pending) == 1:
+                results[pending[0]] = self._request_optimized_prompt(prompts[pending[0]], max_retries - retry_count, deadline)
+                return results
+
+            numbered = "\n\n".join(f"### {number}\n{prompts[i]}" for number, i in enumerate(pending, 1))
+            data = self._optimizer_request_data(
+                system_prompt,
+                f"请将以下每条提示词分别转换为高质量的英文提示词，用于FLUX AI图像生成模型。添加必要的视觉细节、风格描述和技术参数，但保持原始概念不变。按编号依次返回纯文本格式的提示词，不要包含任何JSON结构或标记：\n\n{numbered}",
+                min(500 * len(pending), self.optimizer_batch_max_tokens)
+            )
+            content, filtered = self._post_chat_completion(data, deadline, max_retries)
+            if filtered:
+                logging.warning(f"批量优化触发内容审查，逐条重新优化 {len(pending)} 条提示词")
+                for i in pending:
+                    results[i] = self._request_optimized_prompt(prompts[i], max_retries, deadline)
+                return results
+            if content is None:
+                return results
+
+            items = _parse_numbered_output(content)
+            failed = []
+            for number, i in enumerate(pending, 1):
+                optimized_prompt = items.get(number)
+                if not optimized_prompt:
+                    logging.warning(f"批量优化结果缺少第 {number} 条，重试 {retry_count + 1}/{max_retries}")
+                    failed.append(i)
+                    continue
+                problem = _validate_optimized_prompt(optimized_prompt)
+                if problem is not None:
+                    message, reminder = problem
+                    logging.warning(f"第 {number} 条{message}，重试 {retry_count + 1}/{max_retries}")
+                    if reminder not in system_prompt:
+                        system_prompt += reminder
+                    failed.append(i)
+                    continue
+                print(f"原始提示词: {prompts[i]}")
+                print(f"优化后提示词: {optimized_prompt}")
+                results[i] = optimized_prompt
+            pending = failed
+            if not pending:
+                return results
+
+        logging.warning(f"达到最大重试次数，{len(pending)} 条提示词使用原始提示词")
+        return results
+
+    def _post_chat_completion(self, data, deadline, max_retries=5):
+        """
+        发送一次 chat/completions 请求
+
+        网络错误、429 和 5xx 会按指数退避(带随机抖动)重试，并遵循 Retry-After；不会超过 deadline
+
+        返回:
+            tuple: (返回的文本, 是否触发内容审查)，请求失败或超时时文本为 None
+        """
         # 获取Azure OpenAI API配置
         api_key = os.getenv("AZURE_OPENAI_API_KEY")
         api_base = os.getenv("AZURE_OPENAI_API_BASE")
@@ -216,72 +950,112 @@ class ImageGenerator:
             "Content-Type": "application/json",
             "api-key": api_key
         }
-        
-        # 构建请求体
-        data = {
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "你是一个专业的提示词优化助手，专门为FLUX图像生成模型优化提示词。你的任务是将用户输入的任何语言的提示词转换为高质量、详细的英文提示词。请添加丰富的视觉细节，包括光照效果、材质描述、视角、风格、色彩方案等。使用FLUX模型喜欢的关键词和格式，如'highly detailed'、'4k resolution'、'masterpiece'等增强词。确保最终提示词既保留原始意图，又能最大化FLUX模型的生成效果。请直接返回纯文本格式的提示词，不要包含任何JSON结构、大括号{}、中括号[]、反引号`，也不要在回复中包含'prompt'这个词。"
-                },
-                {
-                    "role": "user",
-                    "content": f"请将以下提示词转换为高质量的英文提示词，用于FLUX AI图像生成模型。添加必要的视觉细节、风格描述和技术参数，但保持原始概念不变。直接返回纯文本格式的提示词，不要包含任何JSON结构或标记：\n\n{prompt}"
-                }
-            ],
-            "temperature": 0.8,
-            "max_tokens": 500,
-            "top_p": 0.95,
-            "response_format": { "type": "text" }
-        }
-        
+
         retry_count = 0
         while retry_count < max_retries:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logging.warning(f"提示词优化超过 {self.optimizer_deadline} 秒的时间预算，返回原始提示词")
+                return None, False
+
+            response = None
             try:
-                # 发送请求
-                response = requests.post(url, headers=headers, json=data)
+                # 发送请求，读超时不超过剩余的时间预算
+                response = self.optimizer_session.post(
+                    url,
+                    headers=headers,
+                    json=data,
+                    timeout=(min(self.optimizer_connect_timeout, remaining), min(self.optimizer_read_timeout, remaining))
+                )
+                # 检查是否为内容过滤错误，Azure 在 400 响应体中返回 content_filter
+                if response.status_code == 400 and "content_filter" in response.text:
+                    return None, True
                 response.raise_for_status()  # 如果请求失败，抛出异常
                 
                 # 解析响应
                 result = response.json()
-                optimized_prompt = result["choices"][0]["message"]["content"].strip()
-                
-                # 验证返回的提示词格式
-                if '{' in optimized_prompt or '}' in optimized_prompt or '[' in optimized_prompt or ']' in optimized_prompt or '`' in optimized_prompt:
-                    logging.warning(f"提示词包含非法字符，重试 {retry_count + 1}/{max_retries}")
-                    retry_count += 1
-                    # 更新系统提示，强调不要包含特殊字符
-                    data["messages"][0]["content"] += " 重要提醒：不要在回复中包含任何大括号{}、中括号[]或反引号`。"
-                    continue
-                    
-                if "prompt" in optimized_prompt.lower():
-                    logging.warning(f"提示词包含'prompt'关键词，重试 {retry_count + 1}/{max_retries}")
-                    retry_count += 1
-                    # 更新系统提示，强调不要包含'prompt'关键词
-                    data["messages"][0]["content"] += " 重要提醒：不要在回复中包含'prompt'这个词。"
-                    continue
-                
-                print(f"原始提示词: {prompt}")
-                print(f"优化后提示词: {optimized_prompt}")
-                
-                return optimized_prompt
+                choice = result["choices"][0]
+                if choice.get("finish_reason") == "content_filter":
+                    return None, True
+                return choice["message"]["content"].strip(), False
             
             except Exception as e:
                 error_str = str(e)
                 # 检查是否为内容过滤错误
                 if "content_filter" in error_str:
-                    print(f"您生成的内容不符合内容审查的规范，请重新使用合适的提示词")
-                    logging.warning(f"您生成的内容不符合内容审查的规范，请重新使用合适的提示词: {prompt}")
-                    return prompt
+                    return None, True
                 
                 logging.error(f"提示词优化失败 (尝试 {retry_count + 1}/{max_retries}): {error_str}")
+                UPSTREAM_ERRORS.inc(
+                    upstream="azure",
+                    type=f"http_{response.status_code}" if response is not None else type(e).__name__
+                )
                 retry_count += 1
                 if retry_count >= max_retries:
                     logging.warning(f"达到最大重试次数，返回原始提示词")
-                    return prompt
-        
-        # 如果所有尝试都失败，返回原始提示词
-        return prompt
+                    return None, False
+
+                # 除 408/429 外的 4xx 错误(如鉴权失败)重试也不会成功
+                status_code = response.status_code if response is not None else None
+                if status_code and 400 <= status_code < 500 and status_code not in (408, 429):
+                    return None, False
+
+                delay = self._retry_delay(retry_count, response)
+                if time.monotonic() + delay >= deadline:
+                    logging.warning(f"等待重试将超过时间预算，返回原始提示词")
+                    return None, False
+                time.sleep(delay)
+
+        return None, False
+
+    def _retry_delay(self, retry_count, response=None):
+        """
+        计算第 retry_count 次重试前的等待时间
+
+        使用 full jitter 的指数退避；响应带有 Retry-After 时至少等待其指定的时间
+        """
+        delay = random.uniform(0, min(self.optimizer_backoff_max, self.optimizer_backoff_base * (2 ** retry_count)))
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+        return delay
+
+
+def _validate_optimized_prompt(text):
+    """
+    检查优化结果是否符合格式要求
+
+    返回:
+        tuple: (问题描述, 重试时追加到系统提示的提醒)，符合要求时返回 None
+    """
+    if any(char in text for char in "{}[]`"):
+        return "提示词包含非法字符", " 重要提醒：不要在回复中包含任何大括号{}、中括号[]或反引号`。"
+    if "prompt" in text.lower():
+        return "提示词包含'prompt'关键词", " 重要提醒：不要在回复中包含'prompt'这个词。"
+    return None
+
+
+# 批量优化结果中每条的开头，例如 "### 3"；编号后只允许空白或标点，避免把 "## 4k" 之类的内容误认为编号
+_NUMBERED_MARKER = re.compile(r"^[ \t*]*#{2,}[ \t]*(\d+)(?=[\s.:：*]|$)[.:：*]*", re.MULTILINE)
+
+
+def _parse_numbered_output(content):
+    """
+    解析批量优化返回的文本
+
+    返回:
+        dict: 编号 -> 该条优化后的提示词，重复的编号只保留第一次出现的内容
+    """
+    markers = list(_NUMBERED_MARKER.finditer(content))
+    items = {}
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(content)
+        text = content[marker.end():end].strip()
+        number = int(marker.group(1))
+        if text and number not in items:
+            items[number] = text
+    return items
 
 
 # 为了保持向后兼容性，提供与原始函数相同的接口
@@ -292,7 +1066,8 @@ async def text2image_from_togetherai_api(prompt: str,
                                         model: str = "black-forest-labs/FLUX.1-schnell-Free",
                                         n: int = 1,
                                         need_optimize_prompt: bool = True):
-    generator = ImageGenerator()
+    from source.registry import get_image_generator
+    generator = get_image_generator()
     return await generator.text2image(
         prompt=prompt,
         generate_steps=generate_steps,
@@ -314,7 +1089,8 @@ async def image2image_from_togetherai_api(
     strength: float = 0.8,
     need_optimize_prompt: bool = False
 ):
-    generator = ImageGenerator()
+    from source.registry import get_image_generator
+    generator = get_image_generator()
     return await generator.image2image(
         image_url=image_url,
         prompt=prompt,
@@ -328,5 +1104,6 @@ async def image2image_from_togetherai_api(
     )
 
 def optimize_prompt(prompt):
-    generator = ImageGenerator()
+    from source.registry import get_image_generator
+    generator = get_image_generator()
     return generator.optimize_prompt(prompt)
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+from source.context import SharedDeadline, join_deadline, with_shared_deadline
+
+
+class MicroBatcher:
+    """
+    将短时间内的并发单条请求合并为一次批量调用
+
+    第一条请求到达后等待 window 秒(或凑满 max_size 条)再统一调用 func，
+    func 接收请求列表，返回按相同顺序排列的结果列表；
+    批量调用的截止时间为批次内所有请求中最晚的一个，任一请求没有截止时间时不限制
+    """
+
+    def __init__(self, func, max_size, window):
+        self.func = func
+        self.max_size = max_size
+        self.window = window
+        self._pending = []
+        self._deadline = SharedDeadline()
+        self._timer = None
+        # 保留正在执行的批次，避免任务在完成前被回收
+        self._tasks = set()
+
+    async def submit(self, item):
+        """
+        提交一条请求并等待其结果，所在批次失败时抛出相同的异常
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        join_deadline(self._deadline)
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        deadline, self._deadline = self._deadline, SharedDeadline()
+        # 等待期间已经取消的请求不再发送
+        batch = [(item, future) for item, future in batch if not future.done()]
+        if not batch:
+            return
+        task = asyncio.create_task(with_shared_deadline(deadline, self._run(batch)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        try:
+            results = await self.func([item for item, _ in batch])
+        except Exception as e:
+            logging.error(f"批量调用失败({len(batch)} 条): {str(e)}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,120 @@
+import os
+import json
+import atexit
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    线程安全的 LRU + TTL 缓存
+
+    - 超过 max_size 时淘汰最久未使用的条目
+    - 条目写入 ttl 秒后过期
+    - 指定 persist_path 时以 JSON 文件持久化，重启后自动加载
+    """
+
+    def __init__(self, max_size=1000, ttl=86400, persist_path=None, persist_interval=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self.persist_interval = persist_interval
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._last_saved = time.time()
+        if self.persist_path:
+            self._load()
+            # 进程退出时写入最后一批变更
+            atexit.register(self.save)
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        """
+        读取缓存，未命中或已过期时返回 None
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    del self._data[key]
+                    self._dirty = True
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._data[key] = (value, time.time() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            self._dirty = True
+            should_save = self.persist_path and time.time() - self._last_saved >= self.persist_interval
+        if should_save:
+            self.save()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
+
+    def _load(self):
+        if not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except Exception as e:
+            logging.warning(f"加载缓存文件失败 {self.persist_path}: {str(e)}")
+            return
+        now = time.time()
+        # 文件中按最近使用顺序保存，依次写入即可恢复 LRU 顺序
+        for key, value, expires_at in entries[-self.max_size:]:
+            if expires_at > now:
+                self._data[key] = (value, expires_at)
+
+    def save(self):
+        """
+        将缓存写入 persist_path，未配置持久化或没有变更时直接返回
+        """
+        if not self.persist_path:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                entries = [[key, value, expires_at] for key, (value, expires_at) in self._data.items()]
+                self._dirty = False
+                self._last_saved = time.time()
+            # 先写临时文件再替换，避免进程中断时留下损坏的缓存文件；
+            # 多进程共用同一个缓存文件时每次写入使用不同的临时文件，避免互相覆盖
+            tmp_path = f"{self.persist_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(entries, f, ensure_ascii=False)
+                os.replace(tmp_path, self.persist_path)
+            except Exception as e:
+                logging.warning(f"保存缓存文件失败 {self.persist_path}: {str(e)}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
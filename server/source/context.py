@@ -0,0 +1,200 @@
+import os
+import time
+import uuid
+import logging
+from contextvars import ContextVar
+
+# 当前请求的ID、耗时记录、截止时间(time.monotonic() 或 SharedDeadline)与租户，通过 contextvars 在协程与线程池之间传递
+request_id_var = ContextVar("request_id", default="-")
+request_timings_var = ContextVar("request_timings", default=None)
+request_deadline_var = ContextVar("request_deadline", default=None)
+request_tenant_var = ContextVar("request_tenant", default="anonymous")
+
+
+class DeadlineExceededError(Exception):
+    """当前请求已经超过截止时间"""
+
+
+class SharedDeadline:
+    """
+    多个请求共享的调用的截止时间
+
+    取所有加入的调用方中最晚的截止时间，任一调用方没有截止时间时为 None；
+    共享调用开始后加入的调用方同样生效，共享调用不会因为某个调用方的截止时间较早而提前失败
+    """
+
+    def __init__(self):
+        self._deadlines = []
+
+    def join(self, deadline):
+        """
+        参数:
+            deadline (float | SharedDeadline): 调用方的截止时间，为 None 表示没有截止时间
+        """
+        self._deadlines.append(deadline)
+
+    @property
+    def value(self):
+        latest = None
+        for deadline in self._deadlines:
+            if isinstance(deadline, SharedDeadline):
+                deadline = deadline.value
+            if deadline is None:
+                return None
+            latest = deadline if latest is None else max(latest, deadline)
+        return latest
+
+
+class RequestTimings:
+    """
+    记录一次请求中各阶段的耗时(秒)
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages = {}
+
+    def record(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+
+def record_timing(stage, seconds):
+    """把耗时记入当前请求，不在请求上下文中时忽略"""
+    timings = request_timings_var.get()
+    if timings is not None:
+        timings.record(stage, seconds)
+
+
+def current_timings():
+    return request_timings_var.get()
+
+
+def current_tenant():
+    return request_tenant_var.get()
+
+
+def _current_deadline():
+    deadline = request_deadline_var.get()
+    return deadline.value if isinstance(deadline, SharedDeadline) else deadline
+
+
+def remaining_time():
+    """
+    距离当前请求截止时间的秒数，没有截止时间时返回 None
+    """
+    deadline = _current_deadline()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def deadline_after(seconds):
+    """
+    返回 seconds 秒之后与当前请求截止时间中较早的一个(time.monotonic())
+    """
+    deadline = time.monotonic() + seconds
+    request_deadline = _current_deadline()
+    return deadline if request_deadline is None else min(deadline, request_deadline)
+
+
+def check_deadline():
+    """当前请求已经超过截止时间时抛出 DeadlineExceededError"""
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceededError("请求已超过截止时间")
+
+
+def join_deadline(shared):
+    """把当前请求的截止时间加入多个请求共享的截止时间"""
+    shared.join(request_deadline_var.get())
+
+
+async def with_shared_deadline(shared, coroutine):
+    """
+    以共享的截止时间执行 coroutine，用于多个请求共享的调用(每个请求仍然按自己的截止时间等待)
+
+    参数:
+        shared (SharedDeadline): 调用方通过 join_deadline 加入的截止时间
+    """
+    token = request_deadline_var.set(shared)
+    try:
+        return await coroutine
+    finally:
+        request_deadline_var.reset(token)
+
+
+class RequestIdFilter(logging.Filter):
+    """为日志记录补充 request_id 字段"""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class RequestContextMiddleware:
+    """
+    为每个 HTTP 请求建立上下文的 ASGI 中间件
+
+    - 使用请求头 X-Request-ID(没有时生成一个)作为请求ID，并在响应头中返回
+    - 创建 RequestTimings 供处理过程记录各阶段耗时
+    - 按请求头 X-Request-Timeout(秒)设置截止时间，不超过 REQUEST_TIMEOUT；REQUEST_TIMEOUT 为 0 时只使用请求头
+    - 以 nginx 转发的 X-Real-IP(没有时使用连接地址)作为租户；API Key(X-API-Key 或 Authorization: Bearer)
+      在 TENANT_API_KEYS 中时改用 API Key，未配置的 API Key 会被忽略，客户端无法通过随意更换 API Key 绕过公平调度
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.default_timeout = float(os.getenv("REQUEST_TIMEOUT", 0))
+        self.tenant_api_keys = {key.strip() for key in os.getenv("TENANT_API_KEYS", "").split(",") if key.strip()}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_id = None
+        timeout = None
+        api_key = None
+        real_ip = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+            elif name == b"x-request-timeout":
+                try:
+                    timeout = float(value.decode("latin-1"))
+                except ValueError:
+                    pass
+            elif name == b"x-api-key":
+                api_key = value.decode("latin-1")
+            elif name == b"authorization" and value[:7].lower() == b"bearer ":
+                api_key = api_key or value[7:].decode("latin-1").strip()
+            elif name == b"x-real-ip":
+                real_ip = value.decode("latin-1")
+        request_id = request_id or uuid.uuid4().hex[:16]
+        client = scope.get("client")
+        if api_key not in self.tenant_api_keys:
+            api_key = None
+        tenant = api_key or real_ip or (client[0] if client else None) or "anonymous"
+        if self.default_timeout > 0:
+            timeout = self.default_timeout if timeout is None else min(timeout, self.default_timeout)
+
+        id_token = request_id_var.set(request_id)
+        timings_token = request_timings_var.set(RequestTimings())
+        deadline_token = request_deadline_var.set(time.monotonic() + timeout if timeout and timeout > 0 else None)
+        tenant_token = request_tenant_var.set(tenant)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_tenant_var.reset(tenant_token)
+            request_deadline_var.reset(deadline_token)
+            request_timings_var.reset(timings_token)
+            request_id_var.reset(id_token)
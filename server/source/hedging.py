@@ -0,0 +1,166 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from source.metrics import HEDGES
+
+
+class LatencyTracker:
+    """
+    按模型记录最近 window 次调用的耗时，用于估计耗时的分位数
+    """
+
+    def __init__(self, window=500, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+
+    def observe(self, model, seconds):
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, model, p):
+        """
+        返回最近耗时的 p 分位数(秒)，样本不足 min_samples 时返回 None
+        """
+        samples = self._samples.get(model)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class HedgeBudget:
+    """
+    对冲请求的预算：每个正常请求积累 ratio 个额度，每次对冲消耗 1 个，
+    对冲请求数长期不超过正常请求数的 ratio 倍，最多累积 burst 个额度
+    """
+
+    def __init__(self, ratio, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self.balance = 0.0
+
+    def deposit(self):
+        self.balance = min(self.burst, self.balance + self.ratio)
+
+    def withdraw(self):
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+class Hedger:
+    """
+    对冲请求：调用超过该模型耗时的 percentile 分位数仍未返回时再发起一次相同的调用，
+    采用先成功返回的结果并取消另一个
+
+    等待时间与耗时样本都从调用真正发给上游时开始计算，排队等待并发名额和限流令牌的时间不计入
+    """
+
+    def __init__(self, percentile=95, budget_ratio=0.1, min_delay=1.0, window=500, min_samples=20):
+        """
+        参数:
+            percentile (float): 触发对冲的耗时分位数，为 0 时关闭对冲
+            budget_ratio (float): 对冲请求占正常请求的最大比例
+            min_delay (float): 触发对冲前至少等待的秒数
+            window (int): 每个模型用于估计分位数的最近调用数
+            min_samples (int): 样本不足时不对冲
+        """
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.tracker = LatencyTracker(window, min_samples)
+        self.budget = HedgeBudget(budget_ratio)
+        self.fired = 0
+        self.won = 0
+
+    @property
+    def enabled(self):
+        return self.percentile > 0 and self.budget.ratio > 0
+
+    def delay(self, model):
+        """该模型当前的对冲等待时间(秒)，样本不足时返回 None"""
+        estimate = self.tracker.percentile(model, self.percentile)
+        if estimate is None:
+            return None
+        return max(self.min_delay, estimate)
+
+    async def run(self, model, call):
+        """
+        执行 call(hedge, on_dispatch)，必要时发起对冲
+
+        参数:
+            model (str): 模型名称，按模型估计耗时
+            call (callable): 接收 hedge(bool) 与 on_dispatch 并返回协程的函数，hedge 为 True 表示对冲请求；
+                调用真正发给上游时需要回调 on_dispatch()，对冲请求的 on_dispatch 为 None
+
+        返回:
+            先成功返回的结果；两个调用都失败时抛出正常请求的异常
+        """
+        self.budget.deposit()
+        delay = self.delay(model)
+        # 正常请求每次发给上游的时刻，切换上游重试时以最后一次为准计算耗时
+        dispatched_at = []
+        dispatched = asyncio.Event()
+
+        def on_dispatch():
+            dispatched_at.append(time.perf_counter())
+            dispatched.set()
+
+        primary = asyncio.ensure_future(call(False, on_dispatch))
+        dispatch_waiter = asyncio.ensure_future(dispatched.wait())
+        try:
+            # 先等待调用发给上游，排队的时间不计入对冲等待时间
+            await asyncio.wait({primary, dispatch_waiter}, return_when=asyncio.FIRST_COMPLETED)
+            if not primary.done():
+                timeout = None if delay is None else max(0.0, dispatched_at[0] + delay - time.perf_counter())
+                await asyncio.wait({primary}, timeout=timeout)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        finally:
+            dispatch_waiter.cancel()
+        done = primary.done()
+        if done or not self.budget.withdraw():
+            if not done:
+                HEDGES.inc(model=model, outcome="no_budget")
+            try:
+                result = await primary
+            except asyncio.CancelledError:
+                primary.cancel()
+                raise
+            self.tracker.observe(model, time.perf_counter() - dispatched_at[-1])
+            return result
+
+        self.fired += 1
+        HEDGES.inc(model=model, outcome="fired")
+        logging.info(f"模型 {model} 的调用超过 {delay:.2f} 秒未返回，发起对冲请求")
+        hedge = asyncio.ensure_future(call(True, None))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.won += 1
+                            HEDGES.inc(model=model, outcome="won")
+                        return task.result()
+            # 两个调用都失败
+            return primary.result()
+        finally:
+            # 被取消的调用耗时至少为当前耗时，同样计入样本，避免慢调用从样本中消失
+            if not primary.done() or (not primary.cancelled() and primary.exception() is None):
+                self.tracker.observe(model, time.perf_counter() - dispatched_at[-1])
+            for task in (primary, hedge):
+                task.cancel()
+
+    def stats(self):
+        return {
+            "fired": self.fired,
+            "won": self.won,
+            "budget": round(self.budget.balance, 2),
+        }
@@ -0,0 +1,226 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+from source.context import current_tenant, request_tenant_var
+
+
+class JobQueueFullError(Exception):
+    """任务队列已满时抛出"""
+
+
+class ImageJob:
+    """
+    一次异步图像生成任务
+
+    状态依次为 queued -> running -> succeeded / failed，
+    任意未结束的状态都可以转为 cancelled
+    """
+
+    def __init__(self, params):
+        self.job_id = uuid.uuid4().hex
+        self.params = params
+        # 任务由 worker 执行，提交时记录租户，执行时按该租户公平排队
+        self.tenant = current_tenant()
+        self.queue_position = None
+        self.quality = None
+        self.status = "queued"
+        self.total = None
+        self.completed = 0
+        self.prompt = None
+        self.results = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.task = None
+        # 已完成的图片按序号记录，便于在任务运行中返回部分结果
+        self._partial = {}
+
+    @property
+    def finished(self):
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    def on_event(self, event):
+        if event["type"] == "started":
+            self.total = event["total"]
+            self.quality = event.get("quality")
+        elif event["type"] == "prompt_optimized":
+            self.prompt = event["prompt"]
+        elif event["type"] == "queued":
+            self.queue_position = event["position"]
+        elif event["type"] == "image_generated":
+            self.queue_position = None
+        elif event["type"] in ("image_uploaded", "image_failed"):
+            self.queue_position = None
+            self.completed += 1
+            self._partial[event["index"]] = {
+                "index": event["index"],
+                "url": event.get("url"),
+                "variants": event.get("variants"),
+                "error": event.get("error"),
+            }
+            self.results = [self._partial[i] for i in sorted(self._partial)]
+
+    def to_dict(self):
+        return {
+            "jobId": self.job_id,
+            "status": self.status,
+            "progress": {"completed": self.completed, "total": self.total},
+            "queuePosition": self.queue_position,
+            "quality": self.quality,
+            "optimizedPrompt": self.prompt,
+            "error": self.error,
+            "createdAt": self.created_at,
+            "finishedAt": self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    进程内的异步任务管理器
+
+    任务放入有界队列，由固定数量的 worker 协程依次执行；
+    结束的任务在 JOB_TTL 秒后被清理
+    """
+
+    def __init__(self, image_generator, max_workers=None, max_queue_size=None, job_ttl=None):
+        self.image_generator = image_generator
+        self.max_workers = max_workers or int(os.getenv("JOB_WORKERS", 4))
+        self.max_queue_size = max_queue_size or int(os.getenv("JOB_QUEUE_SIZE", 100))
+        self.job_ttl = job_ttl or int(os.getenv("JOB_TTL", 3600))
+        self.jobs = {}
+        self.queue = None
+        self.workers = []
+
+    def start(self):
+        # asyncio.Queue 与 worker 需要在事件循环中创建，应用启动或首次提交任务时启动
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        if not self.workers:
+            self.workers = [
+                asyncio.create_task(self._worker(), name=f"image-job-worker-{i}")
+                for i in range(self.max_workers)
+            ]
+
+    def _evict_expired(self):
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.finished and now - job.finished_at > self.job_ttl
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    async def submit(self, params):
+        """
+        提交任务，队列已满时抛出 JobQueueFullError
+
+        参数:
+            params (dict): ImageGenerator.generate_images 的关键字参数
+
+        返回:
+            ImageJob: 新创建的任务
+        """
+        self.start()
+        self._evict_expired()
+        job = ImageJob(params)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise JobQueueFullError(f"任务队列已满({self.max_queue_size})，请稍后重试")
+        self.jobs[job.job_id] = job
+        return job
+
+    def get(self, job_id):
+        self._evict_expired()
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return job
+        job.status = "cancelled"
+        job.finished_at = time.time()
+        if job.task is not None:
+            job.task.cancel()
+        return job
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                # 排队期间被取消的任务直接跳过
+                if job.status != "queued":
+                    continue
+                await self._run_job(job)
+            except Exception as e:
+                logging.error(f"任务 {job.job_id} 执行异常: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    async def _run_job(self, job):
+        job.status = "running"
+        job.started_at = time.time()
+        # 任务复制当前上下文，在其中设置提交任务的租户
+        tenant_token = request_tenant_var.set(job.tenant)
+        try:
+            job.task = asyncio.create_task(
+                self.image_generator.generate_images(**job.params, on_event=job.on_event)
+            )
+        finally:
+            request_tenant_var.reset(tenant_token)
+        try:
+            # 使用 asyncio.wait 等待，避免把任务被取消与 worker 自身被取消混为一谈
+            await asyncio.wait({job.task})
+        except asyncio.CancelledError:
+            job.task.cancel()
+            raise
+        if job.task.cancelled():
+            return
+        try:
+            results = job.task.result()
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            job.finished_at = time.time()
+            return
+
+        job.results = results
+        if results and all(result["error"] for result in results):
+            job.status = "failed"
+            job.error = results[0]["error"]
+        else:
+            job.status = "succeeded"
+        job.finished_at = time.time()
+
+    async def drain(self, timeout):
+        """
+        等待队列中和正在执行的任务完成，最多等待 timeout 秒
+
+        返回:
+            bool: 所有任务是否都已完成
+        """
+        if self.queue is None or not self.workers:
+            return True
+        pending = self.queue.qsize() + sum(1 for job in self.jobs.values() if job.status == "running")
+        if not pending:
+            return True
+        logging.info(f"等待 {pending} 个任务完成，最长 {timeout} 秒")
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"等待任务完成超过 {timeout} 秒，剩余任务将被取消")
+            return False
+        return True
+
+    async def shutdown(self):
+        """取消所有 worker 和正在执行的任务"""
+        for job in self.jobs.values():
+            if not job.finished:
+                self.cancel(job.job_id)
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import email.utils
+from contextlib import asynccontextmanager
+
+
+class UpstreamBusyError(Exception):
+    """
+    上游繁忙(等待队列已满、等待超时或上游返回 429)时抛出
+
+    retry_after 为建议客户端重试前等待的秒数
+    """
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+class TokenBucket:
+    """
+    令牌桶：平均每秒放行 rate 个请求，最多允许 burst 个请求的突发
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def paused_for(self):
+        """距离恢复放行的秒数，未暂停时为 0"""
+        return max(0.0, self.paused_until - time.monotonic())
+
+    def pause(self, seconds):
+        """上游返回 429 时暂停放行，并清空已积累的令牌"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        # 串行发放令牌，保证等待的请求按到达顺序放行
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ModelLimiter:
+    """
+    单个模型的限流器：令牌桶限制速率，信号量限制并发，等待数量有上限
+    """
+
+    def __init__(self, model, rate, burst, concurrency, queue_size, queue_timeout):
+        self.model = model
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self.active = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def _estimate_wait(self):
+        # 粗略估计排在队尾需要等待的时间，用作 Retry-After
+        if self.bucket.rate > 0:
+            return (self.waiting + 1) / self.bucket.rate
+        return self.queue_timeout
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        获取一次上游调用的名额，等待队列已满或等待超时时抛出 UpstreamBusyError
+        """
+        if self.waiting >= self.queue_size:
+            raise UpstreamBusyError(
+                f"模型 {self.model} 繁忙，等待队列已满({self.queue_size})",
+                retry_after=self._estimate_wait()
+            )
+        self.waiting += 1
+        acquired = False
+        try:
+            await asyncio.wait_for(self._acquire(), timeout=self.queue_timeout)
+            acquired = True
+        except asyncio.TimeoutError:
+            raise UpstreamBusyError(
+                f"模型 {self.model} 繁忙，等待超过 {self.queue_timeout} 秒",
+                retry_after=self._estimate_wait()
+            )
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            if acquired:
+                self._semaphore.release()
+
+    async def _acquire(self):
+        await self._semaphore.acquire()
+        try:
+            await self.bucket.acquire()
+        except BaseException:
+            # 等待令牌时超时或被取消，归还并发名额
+            self._semaphore.release()
+            raise
+
+
+class UpstreamLimiter:
+    """
+    按模型划分的上游限流器
+
+    默认参数来自 UPSTREAM_RATE / UPSTREAM_BURST / UPSTREAM_CONCURRENCY /
+    UPSTREAM_QUEUE_SIZE / UPSTREAM_QUEUE_TIMEOUT，UPSTREAM_LIMITS 可以按模型覆盖，例如：
+    {"black-forest-labs/FLUX.1-schnell-Free": {"rate": 0.1, "burst": 1, "concurrency": 2}}
+    """
+
+    def __init__(self, defaults=None):
+        """
+        参数:
+            defaults (dict): 覆盖环境变量中的默认参数，例如某个上游单独的限额
+        """
+        self.defaults = {
+            "rate": float(os.getenv("UPSTREAM_RATE", 2)),
+            "burst": int(os.getenv("UPSTREAM_BURST", 4)),
+            "concurrency": int(os.getenv("UPSTREAM_CONCURRENCY", 8)),
+            "queue_size": int(os.getenv("UPSTREAM_QUEUE_SIZE", 32)),
+            "queue_timeout": float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", 30)),
+            **(defaults or {}),
+        }
+        self.overrides = {}
+        if os.getenv("UPSTREAM_LIMITS"):
+            try:
+                self.overrides = json.loads(os.getenv("UPSTREAM_LIMITS"))
+            except ValueError as e:
+                logging.error(f"UPSTREAM_LIMITS 配置格式错误: {str(e)}")
+        self.limiters = {}
+
+    def for_model(self, model):
+        limiter = self.limiters.get(model)
+        if limiter is None:
+            config = {**self.defaults, **self.overrides.get(model, {})}
+            limiter = ModelLimiter(model, **config)
+            self.limiters[model] = limiter
+        return limiter
+
+    def penalize(self, model, retry_after):
+        """上游返回 429 后暂停该模型的请求"""
+        self.for_model(model).bucket.pause(retry_after)
+
+    def stats(self):
+        return {
+            model: {"waiting": limiter.waiting, "active": limiter.active}
+            for model, limiter in self.limiters.items()
+        }
+
+
+def parse_retry_after(value):
+    """
+    解析 Retry-After 响应头，支持秒数和 HTTP 日期两种格式
+
+    返回:
+        float: 需要等待的秒数，无法解析时返回 None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
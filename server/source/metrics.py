@@ -0,0 +1,243 @@
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+# 覆盖从毫秒级的解码到数十秒的生成
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, math.inf)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value, **labels):
+        """在抓取时同步其他对象维护的累计值，例如缓存的命中次数，该值只应增加"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值"""
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """进入时加一，退出时减一，用于统计进行中的数量"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    """按区间统计耗时分布"""
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [各区间计数, 总和, 总数]
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        with self._lock:
+            items = [(key, ([*state[0]], state[1], state[2])) for key, state in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """以 Prometheus 文本格式输出所有指标"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# 各处理阶段耗时: compose / optimize / generate / decode / upload
+STAGE_DURATION = REGISTRY.register(Histogram(
+    "aigc_stage_duration_seconds", "各处理阶段耗时(秒)", ["stage"]
+))
+OPTIMIZER_BATCH_SIZE = REGISTRY.register(Histogram(
+    "aigc_optimizer_batch_size", "每次提示词优化调用包含的提示词条数", buckets=(1, 2, 4, 8, 16, 32, math.inf)
+))
+HTTP_REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "aigc_http_requests_in_flight", "正在处理中的 HTTP 请求数(流式响应直到推送结束)"
+))
+GENERATIONS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "aigc_generations_in_flight", "正在进行中的生成请求数"
+))
+IMAGES_TOTAL = REGISTRY.register(Counter(
+    "aigc_images_total", "生成图片数量，status 为 success / failed / cached", ["status"]
+))
+UPSTREAM_ERRORS = REGISTRY.register(Counter(
+    "aigc_upstream_errors_total", "上游调用错误次数", ["upstream", "type"]
+))
+HEDGES = REGISTRY.register(Counter(
+    "aigc_hedged_requests_total", "对冲请求次数，outcome 为 fired(已发起) / won(对冲先返回) / no_budget(超出预算未发起)", ["model", "outcome"]
+))
+REQUESTS_CANCELLED = REGISTRY.register(Counter(
+    "aigc_requests_cancelled_total", "提前终止的生成请求数，reason 为 disconnect(客户端断开) / deadline(超过截止时间)", ["reason"]
+))
+QUALITY_LEVEL = REGISTRY.register(Gauge(
+    "aigc_quality_level", "各模型当前的生成质量降级级别，0 为不降级", ["model"]
+))
+UPSTREAM_FAILOVERS = REGISTRY.register(Counter(
+    "aigc_upstream_failovers_total", "生成请求切换到其他上游重试的次数", ["model"]
+))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "aigc_queue_depth", "各队列中等待的数量", ["queue"]
+))
+WRITE_BACK_SPOOL_BYTES = REGISTRY.register(Gauge(
+    "aigc_write_back_spool_bytes", "本地等待后台上传的文件总大小(字节)"
+))
+UPSTREAM_ACTIVE = REGISTRY.register(Gauge(
+    "aigc_upstream_active", "正在进行中的上游调用数", ["model"]
+))
+UPSTREAM_OUTSTANDING = REGISTRY.register(Gauge(
+    "aigc_upstream_outstanding", "各上游进行中与排队中的调用数", ["upstream"]
+))
+UPSTREAM_CIRCUIT_STATE = REGISTRY.register(Gauge(
+    "aigc_upstream_circuit_state", "各上游熔断器状态，0 为 closed，1 为 half_open，2 为 open", ["upstream"]
+))
+CACHE_ENTRIES = REGISTRY.register(Gauge(
+    "aigc_cache_entries", "缓存条目数", ["cache"]
+))
+CACHE_HITS = REGISTRY.register(Counter(
+    "aigc_cache_hits_total", "缓存命中次数(进程启动以来)", ["cache"]
+))
+CACHE_MISSES = REGISTRY.register(Counter(
+    "aigc_cache_misses_total", "缓存未命中次数(进程启动以来)", ["cache"]
+))
+CACHE_HIT_RATIO = REGISTRY.register(Gauge(
+    "aigc_cache_hit_ratio", "缓存命中率", ["cache"]
+))
+
+
+class InFlightMiddleware:
+    """
+    统计正在处理中的 HTTP 请求数的 ASGI 中间件
+
+    直接包装 ASGI 调用，流式响应会一直计数到最后一个事件发送完毕
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        with HTTP_REQUESTS_IN_FLIGHT.track():
+            await self.app(scope, receive, send)
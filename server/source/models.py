@@ -59,4 +59,66 @@ class Text2ImageResponse(BaseModel):
                 "createdAt": "2023-03-09T12:34:56Z"
             }
         ]
-    ) 
\ No newline at end of file
+    )
+    errors: Optional[List[Dict]] = Field(
+        default=None,
+        description="生成失败的图像及错误信息，全部成功时为空",
+        example=[
+            {
+                "id": 2,
+                "error": "Rate limit exceeded"
+            }
+        ]
+    )
+    timings: Optional[Dict] = Field(
+        default=None,
+        description="各阶段耗时(毫秒)，images 中为每张图片的生成与上传耗时",
+        example={
+            "optimize": 1830.2,
+            "total": 6120.5,
+            "images": [{"id": 1, "generate": 3650.1, "upload": 412.7}]
+        }
+    )
+    quality: Optional[Dict] = Field(
+        default=None,
+        description="负载较高而降低生成质量时实际使用的参数，requested 为请求的参数；未降级时为空",
+        example={
+            "level": 2,
+            "steps": 6,
+            "width": 768,
+            "height": 768,
+            "count": 2,
+            "requested": {"steps": 12, "width": 1024, "height": 1024, "count": 4}
+        }
+    )
+
+
+# 定义异步任务响应模型
+class ImageJobResponse(Text2ImageResponse):
+    jobId: str = Field(description="任务ID", example="3f2b8c6e9a8d4f0c9b1e2d3c4b5a6f70")
+    status: str = Field(
+        description="任务状态: queued / running / succeeded / failed / cancelled",
+        example="running"
+    )
+    progress: Dict = Field(
+        description="任务进度，completed 为已完成的图片数，total 为总数",
+        example={"completed": 1, "total": 4}
+    )
+    queuePosition: Optional[int] = Field(default=None, description="等待生成时前面还有多少个生成调用，未排队时为空")
+    optimizedPrompt: Optional[str] = Field(default=None, description="优化后的提示词")
+    error: Optional[str] = Field(default=None, description="任务失败原因")
+    createdAt: float = Field(description="任务创建时间(Unix时间戳)", example=1700000000.0)
+    finishedAt: Optional[float] = Field(default=None, description="任务结束时间(Unix时间戳)")
+
+
+# 定义批量生成响应模型
+class BatchItemResponse(Text2ImageResponse):
+    id: int = Field(description="条目序号，从 1 开始，与请求中 items 的顺序一致", example=1)
+    retryAfter: Optional[int] = Field(default=None, description="上游繁忙时建议重试前等待的秒数")
+
+
+class BatchGenerationResponse(BaseModel):
+    code: int = Field(default=200, description="状态码", example=200)
+    message: str = Field(default="成功", description="状态信息", example="批量生成完成: 成功 2 项, 失败 0 项")
+    unique: int = Field(description="去重后实际生成的条目数", example=2)
+    data: List[BatchItemResponse] = Field(description="每个条目的生成结果，code 为该条目的状态码")
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import logging
+from source.metrics import QUALITY_LEVEL
+
+# 默认的降级阶梯：steps 为步数的比例，max_size 为宽高的上限(像素)，max_count 为单次请求的图片数上限
+DEFAULT_LEVELS = [
+    {"steps": 0.75},
+    {"steps": 0.5, "max_size": 768, "max_count": 2},
+    {"steps": 0.25, "max_size": 512, "max_count": 1},
+]
+
+
+def _parse_thresholds(value):
+    return [float(item) for item in value.split(",") if item.strip()]
+
+
+class QualityLadder:
+    """
+    按负载逐级降低生成质量，负载下降后逐级恢复
+
+    - 排队比例(排队的生成调用数 / 并发数)或上游耗时达到第 i 个阈值时升到第 i 级，升级立即生效
+    - 负载低于阈值的 recovery_ratio 倍后，每在当前级别停留 hold_seconds 秒才恢复一级，避免来回切换
+    - 每个模型单独计算级别，上游耗时按模型比较
+    """
+
+    def __init__(self, levels, queue_thresholds, latency_thresholds=(), recovery_ratio=0.5, hold_seconds=30):
+        """
+        参数:
+            levels (list): 第 1 级开始的降级配置，每项可以包含 steps、max_size、max_count
+            queue_thresholds (list): 进入各级的排队比例，为空时不按排队降级
+            latency_thresholds (list): 进入各级的上游耗时(秒)，为空时不按耗时降级
+            recovery_ratio (float): 负载低于阈值的该倍数时才开始恢复
+            hold_seconds (float): 负载下降后每一级至少停留的秒数
+        """
+        self.levels = levels
+        self.queue_thresholds = queue_thresholds
+        self.latency_thresholds = latency_thresholds
+        self.recovery_ratio = recovery_ratio
+        self.hold_seconds = hold_seconds
+        # 模型 -> (当前级别, 开始计算停留时间的时刻)
+        self._state = {}
+
+    @classmethod
+    def from_env(cls):
+        """
+        按 QUALITY_LADDER / QUALITY_QUEUE_THRESHOLDS / QUALITY_LATENCY_THRESHOLDS /
+        QUALITY_RECOVERY_RATIO / QUALITY_HOLD_SECONDS 创建；两种阈值默认都为空，即默认不降级，
+        QUALITY_LADDER 为 [] 时同样关闭降级
+        """
+        levels = DEFAULT_LEVELS
+        if os.getenv("QUALITY_LADDER"):
+            try:
+                levels = json.loads(os.getenv("QUALITY_LADDER"))
+            except ValueError as e:
+                logging.error(f"QUALITY_LADDER 配置格式错误: {str(e)}")
+        return cls(
+            levels=levels,
+            queue_thresholds=_parse_thresholds(os.getenv("QUALITY_QUEUE_THRESHOLDS", "")),
+            latency_thresholds=_parse_thresholds(os.getenv("QUALITY_LATENCY_THRESHOLDS", "")),
+            recovery_ratio=float(os.getenv("QUALITY_RECOVERY_RATIO", 0.5)),
+            hold_seconds=float(os.getenv("QUALITY_HOLD_SECONDS", 30))
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.levels) and bool(self.queue_thresholds or self.latency_thresholds)
+
+    def _target(self, queue_ratio, latency, ratio=1.0):
+        target = sum(1 for threshold in self.queue_thresholds if queue_ratio >= threshold * ratio)
+        if latency is not None:
+            target = max(target, sum(1 for threshold in self.latency_thresholds if latency >= threshold * ratio))
+        return min(target, len(self.levels))
+
+    def level(self, model, queue_ratio, latency=None):
+        """
+        根据当前负载更新并返回模型的降级级别，0 表示不降级
+
+        参数:
+            model (str): 模型名称
+            queue_ratio (float): 排队的生成调用数与并发数之比
+            latency (float): 该模型最近的上游耗时(秒)，未知时为 None
+        """
+        if not self.enabled:
+            return 0
+        now = time.monotonic()
+        level, held_since = self._state.get(model, (0, now))
+        up = self._target(queue_ratio, latency)
+        down = self._target(queue_ratio, latency, self.recovery_ratio)
+        if up > level:
+            new_level = up
+        elif down >= level:
+            # 负载仍需要当前级别，重新开始计算停留时间
+            new_level = level
+            held_since = now
+        else:
+            # 级别只在请求到来时计算，负载下降后每经过 hold_seconds 秒恢复一级
+            recovered = int((now - held_since) // self.hold_seconds) if self.hold_seconds > 0 else level
+            new_level = max(down, level - recovered)
+        if new_level != level:
+            held_since = now
+            latency_text = f"{latency:.2f} 秒" if latency is not None else "未知"
+            logging.warning(
+                f"模型 {model} 的生成质量{'降低' if new_level > level else '恢复'}到第 {new_level} 级"
+                f"(排队比例 {queue_ratio:.2f}, 上游耗时 {latency_text})"
+            )
+        self._state[model] = (new_level, held_since)
+        QUALITY_LEVEL.set(new_level, model=model)
+        return new_level
+
+    def apply(self, level, steps, width, height, n):
+        """
+        按级别调整生成参数
+
+        返回:
+            tuple: (steps, width, height, n)，宽高按比例缩小并对齐到 16 的倍数
+        """
+        if level <= 0:
+            return steps, width, height, n
+        config = self.levels[level - 1]
+        if config.get("steps") and steps:
+            steps = max(1, round(steps * config["steps"]))
+        max_size = config.get("max_size")
+        if max_size and width and height and max(width, height) > max_size:
+            scale = max_size / max(width, height)
+            width = max(16, int(width * scale) // 16 * 16)
+            height = max(16, int(height * scale) // 16 * 16)
+        if config.get("max_count"):
+            n = min(n, config["max_count"])
+        return steps, width, height, n
+
+    def stats(self):
+        return {model: level for model, (level, _) in self._state.items()}
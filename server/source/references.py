@@ -0,0 +1,257 @@
+import time
+import socket
+import base64
+import binascii
+import hashlib
+import ipaddress
+import threading
+from collections import OrderedDict
+from urllib.parse import urljoin, urlparse
+from source.uploads import decoded_size
+
+
+# 文件头 -> MIME 类型，用于拼接传给上游的 data URL
+_IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+
+
+class ReferenceImageError(ValueError):
+    """参考图无效、过大或无法下载"""
+
+
+def to_data_url(b64_string):
+    """
+    把参考图的 base64 字符串转换为 data URL，作为上游 images.generate 的 image_url
+
+    参数:
+        b64_string (str): 不带前缀的 base64 字符串
+
+    返回:
+        str: data:image/...;base64,... 形式的地址，无法识别的格式按 PNG 处理
+    """
+    head = base64.b64decode(b64_string[:32])
+    mime_type = "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        mime_type = "image/webp"
+    else:
+        for signature, signature_type in _IMAGE_SIGNATURES:
+            if head.startswith(signature):
+                mime_type = signature_type
+                break
+    return f"data:{mime_type};base64,{b64_string}"
+
+
+def _is_public_address(address):
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def parse_reference_image(data, max_bytes):
+    """
+    校验请求中直接上传的参考图，返回不带 data URL 前缀的 base64 字符串
+
+    图片始终保持在内存中直接传给上游，不会先上传到存储再下载回来
+
+    参数:
+        data (str): base64 字符串或 data:image/...;base64,... 形式的 data URL
+        max_bytes (int): 解码后的最大字节数
+
+    返回:
+        str: base64 字符串
+    """
+    b64_string = data.split(",", 1)[1] if data.startswith("data:") else data
+    b64_string = "".join(b64_string.split())
+    size = decoded_size(b64_string)
+    if size > max_bytes:
+        raise ReferenceImageError(f"参考图过大: {size} 字节，上限 {max_bytes} 字节")
+    try:
+        # 只校验开头一段，避免为了校验解码整张图片
+        base64.b64decode(b64_string[:4096], validate=True)
+    except (binascii.Error, ValueError):
+        raise ReferenceImageError("参考图不是有效的 base64 编码")
+    if size == 0:
+        raise ReferenceImageError("参考图为空")
+    return b64_string
+
+
+class ReferenceImageCache:
+    """
+    远程参考图的下载缓存，按 base64 字符串的总大小限制内存占用
+
+    - 以 URL 为 key，记录 ETag / Last-Modified 与内容哈希
+    - 下载后 fresh_ttl 秒内直接使用缓存；之后带上 If-None-Match / If-Modified-Since 重新请求，
+      304 或内容哈希不变时继续使用已编码的 base64，不重复编码
+    - 单张图片下载过程中超过 max_image_bytes 立即中止
+    - 只下载解析到公网地址的图片，拒绝内网、回环、链路本地等地址；重定向的每一跳都重新检查
+    """
+
+    # 重定向最多跟随的次数
+    MAX_REDIRECTS = 3
+
+    def __init__(self, session, max_bytes, max_image_bytes, fresh_ttl=300, timeout=(3, 15), allowed_hosts=None):
+        """
+        参数:
+            session (requests.Session): 下载使用的长连接会话
+            max_bytes (int): 缓存中 base64 字符串的总大小上限，为 0 时不缓存
+            max_image_bytes (int): 单张参考图的最大字节数
+            fresh_ttl (float): 下载后不重新校验的秒数
+            timeout (tuple): 连接与读取超时(秒)
+            allowed_hosts (list): 允许下载的主机名，为空时允许任意公网地址；
+                配置后只允许这些主机，且不再检查其解析到的地址，可用于放行内网的图片服务
+        """
+        self.session = session
+        self.max_bytes = max_bytes
+        self.max_image_bytes = max_image_bytes
+        self.fresh_ttl = fresh_ttl
+        self.timeout = timeout
+        self.allowed_hosts = {host.lower() for host in allowed_hosts or ()}
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, url):
+        with self._lock:
+            entry = self._data.get(url)
+            if entry is not None:
+                self._data.move_to_end(url)
+            return entry
+
+    def _set(self, url, entry):
+        if len(entry["b64"]) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._data.pop(url, None)
+            if previous is not None:
+                self._size -= len(previous["b64"])
+            self._data[url] = entry
+            self._size += len(entry["b64"])
+            while self._size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._size -= len(evicted["b64"])
+
+    def fetch(self, url):
+        """
+        返回 url 对应图片的 base64 字符串，在线程池中执行
+
+        参数:
+            url (str): http / https 地址
+
+        返回:
+            str: base64 字符串
+        """
+        self._check_url(url)
+
+        entry = self._get(url)
+        if entry is not None and time.monotonic() - entry["fetched_at"] < self.fresh_ttl:
+            self.hits += 1
+            return entry["b64"]
+
+        headers = {}
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        with self._get_following_redirects(url, headers) as response:
+            if response.status_code == 304 and entry is not None:
+                self.revalidated += 1
+                self._set(url, {**entry, "fetched_at": time.monotonic()})
+                return entry["b64"]
+            if response.status_code != 200:
+                raise ReferenceImageError(f"无法下载参考图: {response.status_code}")
+            content = self._read_limited(response)
+
+        self.misses += 1
+        content_hash = hashlib.sha256(content).hexdigest()
+        if entry is not None and entry["hash"] == content_hash:
+            # 服务端不支持条件请求但内容没有变化，沿用已编码的结果
+            b64_string = entry["b64"]
+        else:
+            b64_string = base64.b64encode(content).decode("utf-8")
+        self._set(url, {
+            "b64": b64_string,
+            "hash": content_hash,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched_at": time.monotonic(),
+        })
+        return b64_string
+
+    def _check_url(self, url):
+        """
+        拒绝非 http / https 的地址、不在 allowed_hosts 中的主机以及解析到非公网地址的主机
+
+        只在请求前解析检查，不能防止 DNS 在检查之后被改为内网地址，需要更严格时应配置 allowed_hosts
+        """
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise ReferenceImageError(f"不支持的参考图地址: {url}")
+        host = parsed.hostname.lower()
+        if self.allowed_hosts:
+            if host not in self.allowed_hosts:
+                raise ReferenceImageError(f"不允许从该主机下载参考图: {host}")
+            return
+        try:
+            addresses = {info[4][0] for info in socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)}
+        except (socket.gaierror, UnicodeError):
+            raise ReferenceImageError(f"无法解析参考图地址: {host}")
+        # 任一地址不是公网地址都拒绝，避免通过多条解析记录访问内网
+        if not addresses or not all(_is_public_address(address) for address in addresses):
+            raise ReferenceImageError(f"不允许从内网地址下载参考图: {host}")
+
+    def _get_following_redirects(self, url, headers):
+        """
+        不让 requests 自动跟随重定向，手动跟随并检查每一跳的地址
+        """
+        for _ in range(self.MAX_REDIRECTS + 1):
+            response = self.session.get(url, headers=headers, timeout=self.timeout, stream=True, allow_redirects=False)
+            if not response.is_redirect:
+                return response
+            location = response.headers.get("Location")
+            response.close()
+            url = urljoin(url, location)
+            self._check_url(url)
+        raise ReferenceImageError(f"参考图地址重定向次数超过 {self.MAX_REDIRECTS} 次")
+
+    def _read_limited(self, response):
+        content_type = response.headers.get("Content-Type", "")
+        if content_type and not content_type.startswith(("image/", "application/octet-stream")):
+            raise ReferenceImageError(f"参考图地址返回的不是图片: {content_type}")
+        content_length = response.headers.get("Content-Length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_image_bytes:
+            raise ReferenceImageError(f"参考图过大: {content_length} 字节，上限 {self.max_image_bytes} 字节")
+
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            size += len(chunk)
+            # 没有 Content-Length 或与实际不符时，在下载过程中中止
+            if size > self.max_image_bytes:
+                raise ReferenceImageError(f"参考图超过 {self.max_image_bytes} 字节，已中止下载")
+            chunks.append(chunk)
+        if not size:
+            raise ReferenceImageError("参考图为空")
+        return b"".join(chunks)
+
+    def stats(self):
+        with self._lock:
+            size = len(self._data)
+            total_bytes = self._size
+        total = self.hits + self.revalidated + self.misses
+        return {
+            "size": size,
+            "bytes": total_bytes,
+            "hits": self.hits + self.revalidated,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.revalidated) / total if total else 0.0,
+        }
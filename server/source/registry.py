@@ -0,0 +1,58 @@
+import threading
+from source.algorithm import ImageGenerator
+from source.jobs import JobManager
+
+# 进程内共享的实例，首次使用时创建
+_image_generator = None
+_job_manager = None
+_lock = threading.Lock()
+
+
+def get_image_generator():
+    """
+    获取进程内共享的 ImageGenerator
+
+    Together / S3 客户端与各个连接池只在首次调用时创建一次，之后在路由和兼容接口之间复用
+    """
+    global _image_generator
+    if _image_generator is None:
+        with _lock:
+            if _image_generator is None:
+                _image_generator = ImageGenerator()
+    return _image_generator
+
+
+def get_job_manager():
+    """获取进程内共享的 JobManager"""
+    global _job_manager
+    if _job_manager is None:
+        image_generator = get_image_generator()
+        with _lock:
+            if _job_manager is None:
+                _job_manager = JobManager(image_generator)
+    return _job_manager
+
+
+async def startup():
+    """在应用启动时创建客户端并启动任务 worker，避免首个请求承担初始化开销"""
+    get_image_generator()
+    get_job_manager().start()
+
+
+async def shutdown(drain_timeout=0):
+    """
+    在应用关闭时停止任务 worker 并释放客户端与线程池
+
+    参数:
+        drain_timeout (float): 先等待队列中和正在执行的异步任务完成的最长秒数，为 0 时直接取消
+    """
+    global _image_generator, _job_manager
+    if _job_manager is not None and drain_timeout > 0:
+        await _job_manager.drain(drain_timeout)
+    with _lock:
+        image_generator, job_manager = _image_generator, _job_manager
+        _image_generator, _job_manager = None, None
+    if job_manager is not None:
+        await job_manager.shutdown()
+    if image_generator is not None:
+        image_generator.close()
@@ -1,30 +1,272 @@
-from fastapi import APIRouter, HTTPException, Body
-from source.models import Text2ImageRequest, Text2ImageResponse
-from source.algorithm import ImageGenerator
+import os
+import stat
+import asyncio
+import json
+import logging
+from fastapi import APIRouter, HTTPException, Body, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, PlainTextResponse, FileResponse, RedirectResponse
+from source.models import Text2ImageRequest, Text2ImageResponse, ImageJobResponse, BatchGenerationResponse
+from source.jobs import JobQueueFullError
+from source.limiter import UpstreamBusyError
+from source.storage import LocalStorage
+from source.references import ReferenceImageError
+from source.scheduler import PRIORITIES
+from source.registry import get_image_generator, get_job_manager
+from source import metrics
+from source.context import current_timings, remaining_time, DeadlineExceededError
 from typing import Dict, Any
 
 # 创建路由器
 router = APIRouter(tags=["图像生成"])
-image_generator = ImageGenerator()
+
+# 前端请求体示例
+REQUEST_EXAMPLE = {
+    "prompt": "一只可爱的猫咪在草地上玩耍",
+    "negativePrompt": "模糊, 变形, 低质量",
+    "stylePrompt": "写实风格",
+    "colorPrompt": "明亮色彩",
+    "lightPrompt": "自然光照",
+    "compositionPrompt": "居中构图",
+    "count": 1,
+    "width": 1024,
+    "height": 1024,
+    "model": "black-forest-labs/FLUX.1-schnell-Free",
+    "needOptimizePrompt": True
+}
+
+
+# 批量请求体示例
+BATCH_REQUEST_EXAMPLE = {
+    "items": [
+        REQUEST_EXAMPLE,
+        {
+            "prompt": "一只金毛犬在海边奔跑",
+            "count": 2,
+            "needOptimizePrompt": True
+        }
+    ]
+}
+
+
+def _parse_generation_request(request: Dict[str, Any], default_priority="interactive") -> Dict[str, Any]:
+    """
+    将前端请求体转换为 ImageGenerator.generate_images 的参数
+
+    参数:
+        request (dict): 前端请求体
+        default_priority (str): 请求体中没有 priority 时使用的调度优先级
+
+    返回:
+        dict: generate_images 的关键字参数
+    """
+    priority = request.get("priority") or default_priority
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"priority 只能是 {' / '.join(PRIORITIES)}")
+
+    with metrics.STAGE_DURATION.time(stage="compose"):
+        # 组合提示词
+        combined_prompt = request.get("prompt", "")
+
+        # 添加其他提示词
+        if request.get("negativePrompt"):
+            combined_prompt += f", 避免: {request.get('negativePrompt')}"
+        if request.get("stylePrompt"):
+            combined_prompt += f", 风格: {request.get('stylePrompt')}"
+        if request.get("colorPrompt"):
+            combined_prompt += f", 色彩: {request.get('colorPrompt')}"
+        if request.get("lightPrompt"):
+            combined_prompt += f", 光照: {request.get('lightPrompt')}"
+        if request.get("compositionPrompt"):
+            combined_prompt += f", 构图: {request.get('compositionPrompt')}"
+
+    return {
+        "prompt": combined_prompt,
+        # 获取模型选择
+        "model": request.get("model", None),
+        # 获取输出尺寸设置
+        "output_size_width": request.get("width", None),
+        "output_size_height": request.get("height", None),
+        # 获取是否需要提示词优化
+        "need_optimize_prompt": request.get("needOptimizePrompt", True),
+        # 获取生成图片数量
+        "n": request.get("count", 1),
+        # 获取随机种子，相同种子和参数可以复现相同的图片
+        "seed": request.get("seed", None),
+        # noCache 为 True 时跳过生成结果缓存
+        "use_cache": not request.get("noCache", False),
+        # 调度优先级，同一租户的请求之间以及不同租户之间都按优先级排队
+        "priority": priority,
+    }
+
+
+async def _generate_from_reference(image_generator, request, generation_params, on_event=None):
+    """
+    根据参考图进行图生图，结果转换为与 generate_images 相同的格式
+
+    上传的参考图直接在内存中传给上游，不经过存储中转；参考图地址的下载结果会被缓存
+    """
+    reference_image = request.get("referenceImage")
+    image_url = request.get("referenceImageUrl")
+    # 兼容在 referenceImage 中直接传入地址
+    if reference_image and reference_image.startswith(("http://", "https://")):
+        reference_image, image_url = None, reference_image
+    kwargs = {
+        name: generation_params[name]
+        for name in ("prompt", "model", "output_size_width", "output_size_height", "n", "need_optimize_prompt", "priority")
+        if generation_params[name] is not None
+    }
+    urls = await image_generator.image2image(
+        image_url=image_url,
+        reference_image=reference_image,
+        strength=request.get("strength", 0.8),
+        on_event=on_event,
+        **kwargs
+    )
+    return [{"index": i, "url": url, "error": None} for i, url in enumerate(urls)]
+
+
+def _build_image_entries(results):
+    """
+    将 generate_images 的结果转换为响应中的 data 与 errors
+
+    返回:
+        tuple: (generated_images, errors)
+    """
+    generated_images = []
+    errors = []
+    for result in results:
+        i = result["index"]
+        if result["error"]:
+            errors.append({"id": i + 1, "error": result["error"]})
+            continue
+        generated_images.append(_build_image_entry(i, result["url"], result.get("variants")))
+    return generated_images, errors
+
+
+def _build_image_entry(index, url, variants=None):
+    import datetime
+    entry = {
+        "id": index + 1,
+        "url": url,
+        "title": f"生成图片 {index+1}",
+        "createdAt": datetime.datetime.now().isoformat()
+    }
+    # 开启图片变体时返回各格式与缩略图的URL，例如 {"webp": ..., "thumb_256": ...}
+    if variants:
+        entry["variants"] = variants
+    return entry
+
+
+def _build_timings(results):
+    """
+    汇总本次请求的耗时(毫秒)：提示词优化、总耗时以及每张图片的生成和上传耗时
+    """
+    request_timings = current_timings()
+    timings = {}
+    if request_timings is not None:
+        for stage, seconds in request_timings.stages.items():
+            timings[stage] = round(seconds * 1000, 1)
+        timings["total"] = round(request_timings.elapsed() * 1000, 1)
+    timings["images"] = []
+    for result in results:
+        image_timings = result.get("timings")
+        if image_timings:
+            timings["images"].append({
+                "id": result["index"] + 1,
+                **{stage: round(seconds * 1000, 1) for stage, seconds in image_timings.items()}
+            })
+    return timings
+
+
+def _format_server_timing(timings):
+    """
+    将耗时转换为 Server-Timing 响应头，每张图片的耗时以 img{id}-{stage} 命名
+    """
+    entries = []
+    for stage in ("optimize", "total"):
+        if stage in timings:
+            entries.append(f"{stage};dur={timings[stage]}")
+    for image in timings["images"]:
+        for stage, duration in image.items():
+            if stage != "id":
+                entries.append(f'img{image["id"]}-{stage};dur={duration};desc="image {image["id"]} {stage}"')
+    return ", ".join(entries)
+
+
+def _format_sse(event_type, payload):
+    return f"event: {event_type}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+async def _wait_for_disconnect(http_request: Request):
+    # 请求体已经读完，之后 receive 只会在客户端断开时返回 http.disconnect
+    while True:
+        message = await http_request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def _run_cancellable(http_request: Request, coroutine):
+    """
+    执行生成，客户端断开或超过请求截止时间(X-Request-Timeout / REQUEST_TIMEOUT)时立即取消，
+    不再为没有人接收的结果继续调用上游和上传图片
+
+    - 客户端断开: 返回 499
+    - 超过截止时间: 抛出 DeadlineExceededError，由调用方返回 504
+    """
+    task = asyncio.ensure_future(coroutine)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(http_request))
+    try:
+        done, _ = await asyncio.wait({task, watcher}, timeout=remaining_time(), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+    if task in done:
+        return task.result()
+    if watcher in done:
+        metrics.REQUESTS_CANCELLED.inc(reason="disconnect")
+        logging.info("客户端已断开，取消生成")
+        raise HTTPException(status_code=499, detail="客户端已断开")
+    raise DeadlineExceededError("请求已超过截止时间")
+
+
+def _deadline_exceeded(error):
+    metrics.REQUESTS_CANCELLED.inc(reason="deadline")
+    logging.warning(f"请求超过截止时间，已取消生成: {str(error)}")
+    return HTTPException(status_code=504, detail=f"图像生成超时: {str(error)}")
+
+
+async def _next_event(queue):
+    """
+    流式接口读取下一个事件，超过请求截止时间时抛出 DeadlineExceededError
+    """
+    try:
+        return await asyncio.wait_for(queue.get(), timeout=remaining_time())
+    except asyncio.TimeoutError:
+        raise DeadlineExceededError("请求已超过截止时间")
+
+
+def _cancel_stream_task(task, timed_out):
+    # 超过截止时间或客户端提前断开时取消剩余的生成
+    if task.done():
+        return
+    task.cancel()
+    if timed_out:
+        metrics.REQUESTS_CANCELLED.inc(reason="deadline")
+        logging.warning("流式请求超过截止时间，已取消生成")
+    else:
+        metrics.REQUESTS_CANCELLED.inc(reason="disconnect")
+
 
 # 创建路由
 @router.post("/image/generate", response_model=Text2ImageResponse, summary="文本生成图像", description="根据文本提示词生成图像")
 async def image_generation(
+    response: Response,
+    http_request: Request,
     request: Dict[str, Any] = Body(
         ...,
-        example={
-            "prompt": "一只可爱的猫咪在草地上玩耍",
-            "negativePrompt": "模糊, 变形, 低质量",
-            "stylePrompt": "写实风格",
-            "colorPrompt": "明亮色彩",
-            "lightPrompt": "自然光照",
-            "compositionPrompt": "居中构图",
-            "count": 1,
-            "width": 1024,
-            "height": 1024,
-            "model": "black-forest-labs/FLUX.1-schnell-Free",
-            "needOptimizePrompt": True
-        }
+        example=REQUEST_EXAMPLE
     )
 ):
     """
@@ -41,85 +283,386 @@ async def image_generation(
     - **height**: 输出图像高度
     - **model**: 使用的模型名称
     - **needOptimizePrompt**: 是否需要优化提示词
+    - **seed**: 随机种子，可选
+    - **noCache**: 是否跳过生成结果缓存，默认 False；只有指定了 seed 的请求才会使用缓存
+    - **referenceImage**: 参考图(base64 或 data URL)，提供时进行图生图，可选
+    - **referenceImageUrl**: 参考图地址，与 referenceImage 二选一，可选
+    - **strength**: 图生图的转换强度，上游不支持，保留只为兼容，不会生效
+    - **priority**: 调度优先级 interactive(默认) / batch
+
+    生成调用按租户(X-API-Key / Authorization: Bearer，没有时为 X-Real-IP)加权公平排队；
+    请求头 X-Request-Timeout(秒)可以设置截止时间，超过时返回 504；客户端断开后立即停止生成。
+    负载较高时会降低步数、分辨率或图片数量，实际使用的参数在 quality 中返回
     """
     try:
-        # 组合提示词
-        combined_prompt = request.get("prompt", "")
-        
-        # 添加其他提示词
-        if request.get("negativePrompt"):
-            combined_prompt += f", 避免: {request.get('negativePrompt')}"
-        if request.get("stylePrompt"):
-            combined_prompt += f", 风格: {request.get('stylePrompt')}"
-        if request.get("colorPrompt"):
-            combined_prompt += f", 色彩: {request.get('colorPrompt')}"
-        if request.get("lightPrompt"):
-            combined_prompt += f", 光照: {request.get('lightPrompt')}"
-        if request.get("compositionPrompt"):
-            combined_prompt += f", 构图: {request.get('compositionPrompt')}"
-        # 获取模型选择
-        model = request.get("model", None)
+        image_generator = get_image_generator()
+        generation_params = _parse_generation_request(request)
+        started = {}
+        on_event = lambda event: started.update(event) if event["type"] == "started" else None
+        # 有参考图时进行图生图
+        if request.get("referenceImage") or request.get("referenceImageUrl"):
+            generation = _generate_from_reference(image_generator, request, generation_params, on_event)
+        else:
+            generation = image_generator.generate_images(**generation_params, on_event=on_event)
+        results = await _run_cancellable(http_request, generation)
         
-        # 获取输出尺寸设置
-        output_size_width = request.get("width", None)
-        output_size_height = request.get("height", None)
+        # 构建返回结果，失败的图片单独放在 errors 中
+        generated_images, errors = _build_image_entries(results)
         
-        # 获取是否需要提示词优化
-        need_optimize_prompt = request.get("needOptimizePrompt", True)
-        # 获取生成图片数量
-        n = request.get("count", 1)
+        if results and not generated_images:
+            raise Exception(errors[0]["error"])
         
-        image_urls = await image_generator.text2image(
-            prompt=combined_prompt,
-            model=model,
-            output_size_width=output_size_width,
-            output_size_height=output_size_height,
-            n=n,
-            need_optimize_prompt=need_optimize_prompt
-        )
-        # # 判断是否有参考图片
-        # if request.get("referenceImage"):
-        #     # 将base64图像上传到S3并获取URL
-        #     import base64
-        #     import io
-        #     import uuid
-            
-        #     # 解码base64图像
-        #     image_data = base64.b64decode(request.get("referenceImage").split(",")[-1])
-            
-        #     # 上传到S3
-        #     reference_image_url = image_generator._upload_to_s3(image_data, "reference_images")
-            
-        #     # 调用image2image函数
-        #     image_urls = await image_generator.image2image(
-        #         image_url=reference_image_url,
-        #         prompt=combined_prompt,
-        #         n=n
-        #     )
-        # else:
-        #     # 调用text2image函数
-        #     image_urls = await image_generator.text2image(
-        #         prompt=combined_prompt,
-        #         n=n
-        #     )
-        
-        # 构建返回结果
-        generated_images = []
-        for i, url in enumerate(image_urls):
-            import datetime
-            generated_images.append({
-                "id": i + 1,
-                "url": url,
-                "title": f"生成图片 {i+1}",
-                "createdAt": datetime.datetime.now().isoformat()
-            })
+        # 通过 Server-Timing 响应头和 timings 字段返回各阶段耗时
+        timings = _build_timings(results)
+        response.headers["Server-Timing"] = _format_server_timing(timings)
+        logging.info(f"图像生成完成: 成功 {len(generated_images)} 张, 失败 {len(errors)} 张, 耗时 {timings}")
         
         # 返回标准响应格式
         return Text2ImageResponse(
             code=200,
-            message="图像生成成功",
-            data=generated_images
+            message="部分图像生成失败" if errors else "图像生成成功",
+            data=generated_images,
+            errors=errors or None,
+            timings=timings,
+            quality=started.get("quality")
+        )
+    except HTTPException:
+        raise
+    except ReferenceImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except DeadlineExceededError as e:
+        raise _deadline_exceeded(e)
+    except UpstreamBusyError as e:
+        # 上游繁忙时快速失败，告知客户端何时重试
+        raise HTTPException(
+            status_code=503,
+            detail=f"图像生成服务繁忙: {str(e)}",
+            headers={"Retry-After": str(e.retry_after)}
         )
     except Exception as e:
         # 异常处理
         raise HTTPException(status_code=500, detail=f"图像生成失败: {str(e)}")
+
+
+@router.post("/image/generate/stream", summary="流式文本生成图像", description="以 Server-Sent Events 形式实时推送生成进度和每张图片的URL")
+async def image_generation_stream(
+    request: Dict[str, Any] = Body(
+        ...,
+        example=REQUEST_EXAMPLE
+    )
+):
+    """
+    流式文本生成图像API，请求参数与 /image/generate 相同
+
+    依次推送以下事件，每个事件的 data 为 JSON：
+    - **started**: 开始生成，total 为图片总数；负载较高而降低生成质量时 quality 为实际使用的参数
+    - **prompt_optimized**: 提示词优化完成
+    - **queued**: 第 index 张图片正在排队，position 为前面还有多少个生成调用，位置变化时重复推送
+    - **image_generated**: 第 index 张图片已生成，正在上传
+    - **image_uploaded**: 第 index 张图片已上传，image 与 /image/generate 的 data 项格式相同
+    - **image_failed**: 第 index 张图片生成失败
+    - **done**: 全部完成，内容与 /image/generate 的响应相同
+    """
+    params = _parse_generation_request(request)
+    image_generator = get_image_generator()
+
+    async def event_stream():
+        queue = asyncio.Queue()
+        task = asyncio.create_task(image_generator.generate_images(**params, on_event=queue.put_nowait))
+        # 生成结束后放入 None 作为结束标记
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        timed_out = False
+        quality = None
+        try:
+            while True:
+                try:
+                    event = await _next_event(queue)
+                except DeadlineExceededError as e:
+                    timed_out = True
+                    yield _format_sse("done", {"code": 504, "message": f"图像生成超时: {str(e)}", "data": [], "errors": None})
+                    return
+                if event is None:
+                    break
+                event_type = event.pop("type")
+                if event_type == "started":
+                    quality = event.get("quality")
+                if event_type == "image_uploaded":
+                    event["image"] = _build_image_entry(event["index"], event["url"], event.get("variants"))
+                yield _format_sse(event_type, event)
+
+            try:
+                results = task.result()
+            except DeadlineExceededError as e:
+                yield _format_sse("done", {"code": 504, "message": f"图像生成超时: {str(e)}", "data": [], "errors": None})
+                return
+            except UpstreamBusyError as e:
+                yield _format_sse("done", {"code": 503, "message": f"图像生成服务繁忙: {str(e)}", "retryAfter": e.retry_after, "data": [], "errors": None})
+                return
+            except Exception as e:
+                yield _format_sse("done", {"code": 500, "message": f"图像生成失败: {str(e)}", "data": [], "errors": None})
+                return
+            generated_images, errors = _build_image_entries(results)
+            if results and not generated_images:
+                code, message = 500, f"图像生成失败: {errors[0]['error']}"
+            else:
+                code, message = 200, "部分图像生成失败" if errors else "图像生成成功"
+            yield _format_sse("done", {
+                "code": code,
+                "message": message,
+                "data": generated_images,
+                "errors": errors or None,
+                "timings": _build_timings(results),
+                "quality": quality
+            })
+        finally:
+            _cancel_stream_task(task, timed_out)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        # 关闭 nginx 的代理缓冲，保证事件能立即送达前端
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def _parse_batch_request(request: Dict[str, Any], max_items):
+    """
+    校验批量请求体并逐项转换为 generate_images 的参数，没有指定 priority 的条目按 batch 优先级调度
+    """
+    items = request.get("items")
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="items 必须是非空的请求列表")
+    if len(items) > max_items:
+        raise HTTPException(status_code=400, detail=f"单次批量请求最多 {max_items} 项，当前为 {len(items)} 项")
+    if not all(isinstance(item, dict) for item in items):
+        raise HTTPException(status_code=400, detail="items 中的每一项都必须是请求对象")
+    return [_parse_generation_request(item, default_priority="batch") for item in items]
+
+
+def _build_batch_item(index, results, error, quality=None):
+    """
+    将一个条目的生成结果转换为 BatchItemResponse 的字段，quality 为降低生成质量时实际使用的参数
+    """
+    item = {"id": index + 1, "data": [], "errors": None, "quality": quality}
+    if isinstance(error, UpstreamBusyError):
+        item.update(code=503, message=f"图像生成服务繁忙: {str(error)}", retryAfter=error.retry_after)
+    elif isinstance(error, DeadlineExceededError):
+        item.update(code=504, message=f"图像生成超时: {str(error)}")
+    elif error is not None:
+        item.update(code=500, message=f"图像生成失败: {str(error)}")
+    else:
+        generated_images, errors = _build_image_entries(results)
+        if results and not generated_images:
+            item.update(code=500, message=f"图像生成失败: {errors[0]['error']}")
+        else:
+            item.update(code=200, message="部分图像生成失败" if errors else "图像生成成功")
+        item.update(data=generated_images, errors=errors or None)
+    return item
+
+
+def _batch_summary(items):
+    succeeded = sum(1 for item in items if item["code"] == 200)
+    return f"批量生成完成: 成功 {succeeded} 项, 失败 {len(items) - succeeded} 项"
+
+
+@router.post("/image/generate/batch", response_model=BatchGenerationResponse, summary="批量文本生成图像", description="一次提交多个生成请求，相同的请求只生成一次，每项单独返回结果和状态")
+async def image_generation_batch(
+    http_request: Request,
+    request: Dict[str, Any] = Body(
+        ...,
+        example=BATCH_REQUEST_EXAMPLE
+    )
+):
+    """
+    批量文本生成图像API
+
+    - **items**: 请求列表，每项参数与 /image/generate 相同
+
+    参数完全相同的条目只生成一次并返回相同的图片；各条目在所有批量请求共享的有界并发池中执行，
+    单项失败不影响其他条目，data 中每项的 code 为该条目的状态码；
+    负载较高而降低生成质量时，该条目的 quality 为实际使用的参数
+    """
+    image_generator = get_image_generator()
+    params_list = _parse_batch_request(request, image_generator.batch_max_items)
+    started = {}
+    try:
+        outcomes = await _run_cancellable(http_request, image_generator.generate_many(
+            params_list,
+            on_event=lambda event: started.update(event) if event["type"] == "started" else None
+        ))
+    except DeadlineExceededError as e:
+        raise _deadline_exceeded(e)
+    items = [_build_batch_item(i, results, error, quality) for i, (results, error, quality) in enumerate(outcomes)]
+    return BatchGenerationResponse(
+        code=200,
+        message=_batch_summary(items),
+        unique=started["unique"],
+        data=items
+    )
+
+
+@router.post("/image/generate/batch/stream", summary="流式批量文本生成图像", description="以 Server-Sent Events 形式在每个条目完成时推送其结果")
+async def image_generation_batch_stream(
+    request: Dict[str, Any] = Body(
+        ...,
+        example=BATCH_REQUEST_EXAMPLE
+    )
+):
+    """
+    流式批量文本生成图像API，请求参数与 /image/generate/batch 相同
+
+    依次推送以下事件，每个事件的 data 为 JSON：
+    - **started**: 开始生成，total 为条目总数，unique 为去重后的数量
+    - **item**: 一个条目完成，内容与 /image/generate/batch 的 data 项相同，按完成顺序推送
+    - **done**: 全部完成，包含汇总信息
+    """
+    image_generator = get_image_generator()
+    params_list = _parse_batch_request(request, image_generator.batch_max_items)
+
+    async def event_stream():
+        queue = asyncio.Queue()
+        task = asyncio.create_task(image_generator.generate_many(params_list, on_event=queue.put_nowait))
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        items = []
+        timed_out = False
+        try:
+            while True:
+                try:
+                    event = await _next_event(queue)
+                except DeadlineExceededError:
+                    timed_out = True
+                    yield _format_sse("done", {"code": 504, "message": f"批量生成超时: {_batch_summary(items)}", "total": len(items)})
+                    return
+                if event is None:
+                    break
+                if event["type"] == "started":
+                    yield _format_sse("started", {"total": event["total"], "unique": event["unique"]})
+                    continue
+                for index in event["indexes"]:
+                    item = _build_batch_item(index, event["results"], event["error"], event["quality"])
+                    items.append(item)
+                    yield _format_sse("item", item)
+            yield _format_sse("done", {"code": 200, "message": _batch_summary(items), "total": len(items)})
+        finally:
+            _cancel_stream_task(task, timed_out)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def _build_job_response(job, message):
+    job_info = job.to_dict()
+    generated_images, errors = _build_image_entries(job.results or [])
+    return ImageJobResponse(
+        code=200,
+        message=message,
+        data=generated_images,
+        errors=errors or None,
+        **job_info
+    )
+
+
+@router.post("/image/jobs", response_model=ImageJobResponse, status_code=202, summary="提交图像生成任务", description="异步提交图像生成任务，立即返回任务ID")
+async def submit_image_job(
+    request: Dict[str, Any] = Body(
+        ...,
+        example=REQUEST_EXAMPLE
+    )
+):
+    """
+    异步图像生成API，请求参数与 /image/generate 相同
+
+    返回的 jobId 可用于 GET /image/jobs/{jobId} 查询进度、排队位置和结果；没有指定 priority 时按 batch 优先级调度
+    """
+    try:
+        job = await get_job_manager().submit(_parse_generation_request(request, default_priority="batch"))
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "10"})
+    return _build_job_response(job, "任务已提交")
+
+
+@router.get("/image/jobs/{job_id}", response_model=ImageJobResponse, summary="查询图像生成任务", description="查询任务状态、进度和已生成的图像")
+async def get_image_job(job_id: str):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    return _build_job_response(job, "查询成功")
+
+
+@router.delete("/image/jobs/{job_id}", response_model=ImageJobResponse, summary="取消图像生成任务", description="取消排队中或执行中的任务")
+async def cancel_image_job(job_id: str):
+    job = get_job_manager().cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    return _build_job_response(job, "任务已取消")
+
+
+def _collect_runtime_metrics():
+    """在抓取时读取队列长度、上游并发和缓存命中率等瞬时值"""
+    image_generator = get_image_generator()
+    job_manager = get_job_manager()
+
+    job_queue = job_manager.queue.qsize() if job_manager.queue is not None else 0
+    metrics.QUEUE_DEPTH.set(job_queue, queue="jobs")
+    metrics.QUEUE_DEPTH.set(image_generator.upload_stats.snapshot()["queued"], queue="upload")
+    if hasattr(image_generator.storage, "stats"):
+        storage_stats = image_generator.storage.stats()
+        metrics.QUEUE_DEPTH.set(storage_stats["pending"], queue="write_back")
+        metrics.WRITE_BACK_SPOOL_BYTES.set(storage_stats["spool_bytes"])
+    for priority, waiting in image_generator.scheduler.stats()["waiting"].items():
+        metrics.QUEUE_DEPTH.set(waiting, queue=f"scheduler:{priority}")
+    for model, stats in image_generator.upstream_pool.limiter_stats().items():
+        metrics.QUEUE_DEPTH.set(stats["waiting"], queue=f"upstream:{model}")
+        metrics.UPSTREAM_ACTIVE.set(stats["active"], model=model)
+    circuit_states = {"closed": 0, "half_open": 1, "open": 2}
+    for name, stats in image_generator.upstream_pool.stats().items():
+        metrics.UPSTREAM_OUTSTANDING.set(stats["outstanding"], upstream=name)
+        metrics.UPSTREAM_CIRCUIT_STATE.set(circuit_states[stats["state"]], upstream=name)
+
+    for name, cache in (
+        ("prompt", image_generator.prompt_cache),
+        ("result", image_generator.result_cache),
+        ("reference", image_generator.reference_cache),
+    ):
+        stats = cache.stats()
+        metrics.CACHE_ENTRIES.set(stats["size"], cache=name)
+        metrics.CACHE_HITS.set_total(stats["hits"], cache=name)
+        metrics.CACHE_MISSES.set_total(stats["misses"], cache=name)
+        metrics.CACHE_HIT_RATIO.set(stats["hit_ratio"], cache=name)
+
+
+@router.api_route("/files/{key:path}", methods=["GET", "HEAD"], include_in_schema=False)
+async def get_file(key: str):
+    """
+    读取本地存储(STORAGE_BACKEND=local / write_back)中的图片
+
+    write_back 模式下已上传并从本地删除的文件重定向到 S3 上的地址
+    """
+    storage = get_image_generator().storage
+    if not isinstance(storage, LocalStorage):
+        raise HTTPException(status_code=404, detail="未启用本地存储")
+    path = storage.path(key)
+    if path is not None:
+        # write_back 的后台上传可能随时删除本地文件：在线程池中读取一次文件信息，
+        # 文件已被删除时重定向到 S3；把读取到的信息交给 FileResponse，不再重复检查，同时保留 Range / HEAD 支持
+        try:
+            stat_result = await run_in_threadpool(os.stat, path)
+        except FileNotFoundError:
+            stat_result = None
+        if stat_result is not None and stat.S_ISREG(stat_result.st_mode):
+            # 文件名包含唯一ID，内容不会变化
+            return FileResponse(path, stat_result=stat_result, headers={"Cache-Control": "public, max-age=31536000, immutable"})
+    fallback_url = storage.fallback_url(key) if path is not None else None
+    if fallback_url:
+        return RedirectResponse(fallback_url, status_code=307)
+    raise HTTPException(status_code=404, detail="文件不存在")
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    """Prometheus 指标"""
+    _collect_runtime_metrics()
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
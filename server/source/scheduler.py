@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import itertools
+from contextlib import asynccontextmanager
+from source.limiter import UpstreamBusyError
+from source.metrics import STAGE_DURATION
+from source.context import DeadlineExceededError, remaining_time
+
+# 优先级从高到低，interactive 始终先于 batch 调度
+PRIORITIES = ("interactive", "batch")
+
+
+class SchedulerBusyError(UpstreamBusyError):
+    """调度队列已满或排队超时时抛出，与上游繁忙一样返回 503"""
+
+
+class _Ticket:
+    """一次等待调度的生成调用"""
+
+    def __init__(self, tenant, priority, cost, start_tag, finish_tag, seq, on_position):
+        self.tenant = tenant
+        self.priority = priority
+        self.cost = cost
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.seq = seq
+        self.on_position = on_position
+        self.position = None
+        self.enqueued_at = time.perf_counter()
+        self.future = asyncio.get_running_loop().create_future()
+
+    def sort_key(self):
+        return (PRIORITIES.index(self.priority), self.start_tag, self.seq)
+
+
+class FairScheduler:
+    """
+    生成调用的加权公平调度器，位于上游调用之前
+
+    - 按租户(X-Real-IP / TENANT_API_KEYS 中的 API Key)做加权公平排队(start-time fair queuing)：
+      每个租户的调用按 cost / weight 累加虚拟时间，虚拟时间小的先调度，
+      一次请求 6 张图片的租户不会挡住只请求 1 张的其他租户
+    - interactive 优先于 batch
+    - 同时进行的调用总数不超过 capacity，单个租户不超过 tenant_quota；
+      超过配额的租户不会挡住其他租户
+    - 排队时间不超过 queue_timeout 与请求的剩余时间
+    """
+
+    def __init__(self, capacity, tenant_quota=0, weights=None, queue_size=256, queue_timeout=30):
+        """
+        参数:
+            capacity (int): 同时进行的调用数(按 cost 计)，为 0 时不调度
+            tenant_quota (int): 单个租户同时进行的调用数上限，为 0 时不限制
+            weights (dict): 租户 -> 权重，默认为 1
+            queue_size (int): 等待调度的调用数上限，超过时抛出 SchedulerBusyError
+            queue_timeout (float): 最长排队秒数，超过时抛出 SchedulerBusyError
+        """
+        self.capacity = capacity
+        self.tenant_quota = tenant_quota
+        self.weights = weights or {}
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.dispatched = 0
+        self._virtual_time = 0.0
+        self._last_finish = {}
+        self._tenant_active = {}
+        self._queue = []
+        self._seq = itertools.count()
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    @asynccontextmanager
+    async def slot(self, tenant, priority="interactive", cost=1, on_position=None):
+        """
+        等待调度后执行一次生成调用
+
+        参数:
+            tenant (str): 租户标识
+            priority (str): interactive / batch
+            cost (int): 占用的并发数，例如一次生成的图片张数
+            on_position (callable): 排队位置变化时回调，参数为前面还有多少个调用(从 1 开始)
+        """
+        if not self.enabled:
+            yield
+            return
+        ticket = self._enqueue(tenant, priority, cost, on_position)
+        if not ticket.future.done():
+            remaining = remaining_time()
+            timeout = self.queue_timeout if remaining is None else max(0.0, min(self.queue_timeout, remaining))
+            try:
+                # asyncio.wait 超时不会取消 future，避免与调度同时发生时丢失已分配的名额
+                await asyncio.wait({ticket.future}, timeout=timeout)
+            except asyncio.CancelledError:
+                # 已被调度但还没来得及执行时同样需要归还名额
+                if ticket.future.done() and not ticket.future.cancelled():
+                    self._release(ticket)
+                else:
+                    self._remove(ticket)
+                raise
+            if not ticket.future.done():
+                self._remove(ticket)
+                if remaining is not None and remaining <= self.queue_timeout:
+                    raise DeadlineExceededError("排队等待生成时超过请求截止时间")
+                raise SchedulerBusyError(f"生成排队超过 {self.queue_timeout} 秒", retry_after=self.queue_timeout)
+            STAGE_DURATION.observe(time.perf_counter() - ticket.enqueued_at, stage="queue")
+        try:
+            yield
+        finally:
+            self._release(ticket)
+
+    def _enqueue(self, tenant, priority, cost, on_position):
+        if priority not in PRIORITIES:
+            raise ValueError(f"不支持的优先级: {priority}，可选值为 {', '.join(PRIORITIES)}")
+        if len(self._queue) >= self.queue_size:
+            raise SchedulerBusyError(f"生成队列已满({self.queue_size})")
+        # 单次调用不超过总并发数，否则永远无法调度
+        cost = max(1, min(cost, self.capacity))
+        weight = self.weights.get(tenant, 1.0)
+        # 空闲的租户不能积攒额度：开始时间不早于当前的虚拟时间
+        start_tag = max(self._virtual_time, self._last_finish.get(tenant, 0.0))
+        finish_tag = start_tag + cost / weight
+        self._last_finish[tenant] = finish_tag
+        ticket = _Ticket(tenant, priority, cost, start_tag, finish_tag, next(self._seq), on_position)
+        self._queue.append(ticket)
+        self._dispatch()
+        return ticket
+
+    def _fits_quota(self, ticket):
+        active = self._tenant_active.get(ticket.tenant, 0)
+        # 租户没有进行中的调用时总是允许，避免 cost 大于配额的调用永远无法调度
+        return not self.tenant_quota or active == 0 or active + ticket.cost <= self.tenant_quota
+
+    def _dispatch(self):
+        self._queue.sort(key=_Ticket.sort_key)
+        remaining = []
+        blocked = False
+        for ticket in self._queue:
+            if blocked or not self._fits_quota(ticket):
+                remaining.append(ticket)
+                continue
+            if self.active + ticket.cost > self.capacity:
+                # 总并发不足时不再调度后面更小的调用，避免大的调用一直等待
+                blocked = True
+                remaining.append(ticket)
+                continue
+            self.active += ticket.cost
+            self._tenant_active[ticket.tenant] = self._tenant_active.get(ticket.tenant, 0) + ticket.cost
+            self._virtual_time = max(self._virtual_time, ticket.start_tag)
+            self.dispatched += 1
+            ticket.future.set_result(None)
+        self._queue = remaining
+        self._notify_positions()
+
+    def _notify_positions(self):
+        for position, ticket in enumerate(self._queue, start=1):
+            if ticket.position == position:
+                continue
+            ticket.position = position
+            if ticket.on_position is not None:
+                try:
+                    ticket.on_position(position)
+                except Exception as e:
+                    logging.warning(f"排队位置回调失败: {str(e)}")
+
+    def _remove(self, ticket):
+        if ticket in self._queue:
+            self._queue.remove(ticket)
+            self._dispatch()
+
+    def _release(self, ticket):
+        self.active -= ticket.cost
+        tenant_active = self._tenant_active.get(ticket.tenant, 0) - ticket.cost
+        if tenant_active > 0:
+            self._tenant_active[ticket.tenant] = tenant_active
+        else:
+            self._tenant_active.pop(ticket.tenant, None)
+            # 租户空闲且没有排队的调用时清理其虚拟时间，避免租户数量无限增长
+            if self._last_finish.get(ticket.tenant, 0.0) <= self._virtual_time and not any(
+                queued.tenant == ticket.tenant for queued in self._queue
+            ):
+                self._last_finish.pop(ticket.tenant, None)
+        self._dispatch()
+
+    def stats(self):
+        waiting = {priority: 0 for priority in PRIORITIES}
+        for ticket in self._queue:
+            waiting[ticket.priority] += ticket.cost
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "waiting": waiting,
+            "tenants": len(self._tenant_active),
+            "dispatched": self.dispatched,
+        }
+
+
+class ModelSchedulers:
+    """
+    按模型划分的公平调度器，每个模型单独排队
+
+    每个模型的并发数默认等于支持它的上游对该模型的并发数之和(包括 UPSTREAM_LIMITS 中按模型的覆盖)，
+    使排队发生在调度器而不是上游限流器中，上游限流器的先进先出队列不会绕过公平调度
+    """
+
+    def __init__(self, capacity_for, capacity=None, tenant_quota=0, weights=None, queue_size=256, queue_timeout=30):
+        """
+        参数:
+            capacity_for (callable): 接收模型名称，返回该模型默认的并发数
+            capacity (int): 配置后所有模型都使用该并发数，为 0 时不调度
+            其余参数见 FairScheduler
+        """
+        self.capacity_for = capacity_for
+        self.capacity = capacity
+        self.tenant_quota = tenant_quota
+        self.weights = weights or {}
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.schedulers = {}
+
+    @classmethod
+    def from_env(cls, capacity_for):
+        """
+        按 SCHEDULER_CAPACITY / TENANT_MAX_CONCURRENCY / TENANT_WEIGHTS / SCHEDULER_QUEUE_SIZE /
+        SCHEDULER_QUEUE_TIMEOUT 创建调度器
+        """
+        weights = {}
+        if os.getenv("TENANT_WEIGHTS"):
+            try:
+                weights = {tenant: float(weight) for tenant, weight in json.loads(os.getenv("TENANT_WEIGHTS")).items()}
+            except (ValueError, AttributeError) as e:
+                logging.error(f"TENANT_WEIGHTS 配置格式错误: {str(e)}")
+        capacity = os.getenv("SCHEDULER_CAPACITY")
+        return cls(
+            capacity_for,
+            capacity=int(capacity) if capacity else None,
+            tenant_quota=int(os.getenv("TENANT_MAX_CONCURRENCY", 0)),
+            weights=weights,
+            queue_size=int(os.getenv("SCHEDULER_QUEUE_SIZE", 256)),
+            queue_timeout=float(os.getenv("SCHEDULER_QUEUE_TIMEOUT", 30))
+        )
+
+    @property
+    def enabled(self):
+        return self.capacity != 0
+
+    def for_model(self, model):
+        scheduler = self.schedulers.get(model)
+        if scheduler is None:
+            scheduler = FairScheduler(
+                capacity=self.capacity if self.capacity is not None else self.capacity_for(model),
+                tenant_quota=self.tenant_quota,
+                weights=self.weights,
+                queue_size=self.queue_size,
+                queue_timeout=self.queue_timeout
+            )
+            self.schedulers[model] = scheduler
+        return scheduler
+
+    def slot(self, model, tenant, priority="interactive", cost=1, on_position=None):
+        """在模型对应的调度器上等待调度，参数见 FairScheduler.slot"""
+        return self.for_model(model).slot(tenant, priority, cost, on_position)
+
+    def stats(self):
+        """所有模型汇总的调度状态，models 中为各模型的状态"""
+        models = {model: scheduler.stats() for model, scheduler in self.schedulers.items()}
+        waiting = {priority: sum(stats["waiting"][priority] for stats in models.values()) for priority in PRIORITIES}
+        return {
+            "capacity": sum(stats["capacity"] for stats in models.values()),
+            "active": sum(stats["active"] for stats in models.values()),
+            "waiting": waiting,
+            "dispatched": sum(stats["dispatched"] for stats in models.values()),
+            "models": models,
+        }
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from source.context import SharedDeadline, join_deadline, with_shared_deadline
+
+
+class _Call:
+    """一次正在进行中的共享调用"""
+
+    def __init__(self):
+        self.task = None
+        self.deadline = SharedDeadline()
+        self.waiters = 0
+        self.listeners = []
+
+    def broadcast(self, event):
+        # 把共享调用产生的事件转发给所有仍在等待的调用方
+        for listener in list(self.listeners):
+            try:
+                listener(event)
+            except Exception as e:
+                logging.warning(f"事件回调失败: {str(e)}")
+
+
+class SingleFlight:
+    """
+    合并相同 key 的并发调用
+
+    同一时刻相同 key 的调用只执行一次，所有调用方共享同一个结果或异常；
+    单个调用方被取消不会影响其他调用方，只有所有调用方都离开时才取消共享调用；
+    共享调用的截止时间为所有调用方中最晚的一个，任一调用方没有截止时间时不限制
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+    async def do(self, key, func, on_event=None):
+        """
+        执行或加入 key 对应的共享调用
+
+        参数:
+            key (str): 调用的唯一标识
+            func (callable): 接收 broadcast 回调并返回协程的函数，只在没有进行中的调用时执行
+            on_event (callable): 接收共享调用通过 broadcast 发出的事件，可选
+
+        返回:
+            共享调用的返回值
+        """
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call()
+            join_deadline(call.deadline)
+            call.task = asyncio.ensure_future(with_shared_deadline(call.deadline, func(call.broadcast)))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self.executed += 1
+        else:
+            join_deadline(call.deadline)
+            self.coalesced += 1
+
+        if on_event is not None:
+            call.listeners.append(on_event)
+        call.waiters += 1
+        try:
+            # shield 保证某个调用方被取消时共享调用仍然继续
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if on_event is not None:
+                call.listeners.remove(on_event)
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+                self._forget(key, call)
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
@@ -0,0 +1,356 @@
+import os
+import time
+import uuid
+import queue
+import base64
+import random
+import logging
+import mimetypes
+import threading
+import boto3
+from botocore.config import Config as BotoConfig
+from boto3.s3.transfer import TransferConfig
+from source.uploads import Base64DecodeStream, decoded_size
+from source.metrics import STAGE_DURATION, UPSTREAM_ERRORS
+
+
+class S3Storage:
+    """
+    保存到 S3 兼容的对象存储，需要 S3_ENDPOINT_URL / S3_ACCESS_KEY_ID / S3_SECRET_ACCESS_KEY / S3_BUCKET_NAME
+    """
+
+    def __init__(self, client=None, max_pool_connections=8, multipart_threshold=8 * 1024 * 1024):
+        """
+        参数:
+            client: S3 客户端，默认按环境变量创建，压测时可以传入本地替身
+            max_pool_connections (int): 连接池大小，与上传线程数一致
+            multipart_threshold (int): 超过该字节数的图片边解码边分片上传
+        """
+        missing_vars = [
+            var for var in ("S3_ENDPOINT_URL", "S3_ACCESS_KEY_ID", "S3_SECRET_ACCESS_KEY", "S3_BUCKET_NAME")
+            if not os.getenv(var)
+        ]
+        if missing_vars and client is None:
+            raise EnvironmentError(f"缺少必要的环境变量: {','.join(missing_vars)}")
+        self.endpoint_url = os.getenv("S3_ENDPOINT_URL")
+        self.bucket = os.getenv("S3_BUCKET_NAME")
+        self.multipart_threshold = multipart_threshold
+        self.client = client or boto3.client(
+            "s3",
+            aws_access_key_id=os.getenv("S3_ACCESS_KEY_ID"),
+            aws_secret_access_key=os.getenv("S3_SECRET_ACCESS_KEY"),
+            endpoint_url=self.endpoint_url,
+            config=BotoConfig(max_pool_connections=max_pool_connections)
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_threshold,
+            # 上传已经在上传线程池中并发执行，分片在当前线程内依次上传即可
+            use_threads=False
+        )
+
+    def url(self, key):
+        return f"{self.endpoint_url}/{self.bucket}/{key}"
+
+    def save(self, key, data, content_type="image/png"):
+        # 直接上传到S3，不需要存储到本地，bytes 可以直接作为请求体
+        with STAGE_DURATION.time(stage="upload"):
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=key,
+                Body=data,
+                ACL='public-read',
+                ContentType=content_type
+            )
+        return self.url(key)
+
+    def save_b64(self, key, b64_string, content_type="image/png"):
+        """
+        小于 multipart_threshold 的图片解码一次后直接上传；
+        更大的图片边解码边分片上传，不会在内存中保留完整的解码结果
+        """
+        if decoded_size(b64_string) < self.multipart_threshold:
+            with STAGE_DURATION.time(stage="decode"):
+                image_data = base64.b64decode(b64_string)
+            return self.save(key, image_data, content_type)
+
+        # 分片上传时解码与上传交替进行，耗时统一计入 upload 阶段
+        return self._upload_fileobj(key, Base64DecodeStream(b64_string), content_type)
+
+    def save_file(self, key, path, content_type="image/png"):
+        """上传本地文件，大文件自动分片"""
+        with open(path, "rb") as f:
+            return self._upload_fileobj(key, f, content_type)
+
+    def _upload_fileobj(self, key, fileobj, content_type):
+        with STAGE_DURATION.time(stage="upload"):
+            self.client.upload_fileobj(
+                fileobj,
+                self.bucket,
+                key,
+                ExtraArgs={"ACL": "public-read", "ContentType": content_type},
+                Config=self.transfer_config
+            )
+        return self.url(key)
+
+    def close(self):
+        pass
+
+
+class LocalStorage:
+    """
+    保存到本地磁盘，由 /files/{key} 路由对外提供访问
+    """
+
+    def __init__(self, root, base_url):
+        """
+        参数:
+            root (str): 保存图片的目录
+            base_url (str): 对外访问的URL前缀，例如 http://127.0.0.1:11002/files
+        """
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(self.root, exist_ok=True)
+
+    def url(self, key):
+        return f"{self.base_url}/{key}"
+
+    def path(self, key):
+        """
+        返回 key 对应的本地路径，key 试图访问目录之外的文件时返回 None
+        """
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def fallback_url(self, key):
+        """本地文件不存在时可以重定向到的地址，本地存储没有"""
+        return None
+
+    def _write(self, key, chunks):
+        # 先写入临时文件再重命名，读取方不会看到写了一半的文件
+        path = self.path(key)
+        if path is None:
+            raise ValueError(f"非法的文件名: {key}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        size = 0
+        with STAGE_DURATION.time(stage="upload"):
+            try:
+                with open(temp_path, "wb") as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                        size += len(chunk)
+                os.replace(temp_path, path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        return path, size
+
+    def save(self, key, data, content_type="image/png"):
+        self._write(key, [data])
+        return self.url(key)
+
+    def save_b64(self, key, b64_string, content_type="image/png"):
+        self._write(key, _iter_decoded(b64_string))
+        return self.url(key)
+
+    def close(self):
+        pass
+
+
+def _iter_decoded(b64_string, chunk_size=1024 * 1024):
+    # 分段解码写入，不在内存中保留完整的解码结果
+    stream = Base64DecodeStream(b64_string)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+class WriteBackStorage(LocalStorage):
+    """
+    先写入本地磁盘并立即返回，再由后台线程上传到 S3
+
+    - 上传失败按指数退避无限重试，文件在上传成功前一直保留在本地，进程重启后会重新排队
+    - 待上传文件的总大小超过 spool_max_bytes 时不再写入本地，直接同步上传到 S3
+    - 上传成功后删除本地文件，/files/{key} 会重定向到 S3 上的地址
+    """
+
+    def __init__(self, remote, root, base_url, spool_max_bytes, workers=2, return_remote_url=False,
+                 backoff_base=1.0, backoff_max=60.0, stale_tmp_seconds=3600):
+        """
+        参数:
+            remote (S3Storage): 最终保存的位置
+            spool_max_bytes (int): 本地待上传文件的总大小上限
+            workers (int): 后台上传线程数
+            return_remote_url (bool): 是否直接返回 S3 地址(上传完成前访问会失败)，默认返回本地地址
+            stale_tmp_seconds (float): 启动时只清理修改时间早于该秒数的临时文件，
+                多进程共用目录时不会删除其他进程正在写入的文件
+        """
+        super().__init__(root, base_url)
+        self.remote = remote
+        self.spool_max_bytes = spool_max_bytes
+        self.return_remote_url = return_remote_url
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.spool_bytes = 0
+        self.uploaded = 0
+        self.retries = 0
+        self.bypassed = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._stopping = threading.Event()
+
+        # 重新排队上次退出时尚未上传的文件，并清理中断写入时留下的临时文件
+        now = time.time()
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    if filename.endswith(".tmp"):
+                        if now - os.path.getmtime(path) > stale_tmp_seconds:
+                            os.remove(path)
+                        continue
+                    size = os.path.getsize(path)
+                except FileNotFoundError:
+                    # 其他进程刚好完成写入或上传
+                    continue
+                self._enqueue(os.path.relpath(path, self.root).replace(os.sep, "/"), size)
+        if not self._queue.empty():
+            logging.info(f"发现 {self._queue.qsize()} 个未上传的文件，重新加入上传队列")
+
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"write-back-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _enqueue(self, key, size):
+        with self._lock:
+            self.spool_bytes += size
+        self._queue.put((key, size))
+
+    def _has_room(self, size):
+        with self._lock:
+            return self.spool_bytes + size <= self.spool_max_bytes
+
+    def _result_url(self, key):
+        return self.remote.url(key) if self.return_remote_url else self.url(key)
+
+    def fallback_url(self, key):
+        return self.remote.url(key)
+
+    def save(self, key, data, content_type="image/png"):
+        if not self._has_room(len(data)):
+            self.bypassed += 1
+            return self.remote.save(key, data, content_type)
+        _, size = self._write(key, [data])
+        self._enqueue(key, size)
+        return self._result_url(key)
+
+    def save_b64(self, key, b64_string, content_type="image/png"):
+        if not self._has_room(decoded_size(b64_string)):
+            self.bypassed += 1
+            return self.remote.save_b64(key, b64_string, content_type)
+        _, size = self._write(key, _iter_decoded(b64_string))
+        self._enqueue(key, size)
+        return self._result_url(key)
+
+    def _worker(self):
+        while not self._stopping.is_set():
+            try:
+                key, size = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._upload(key, size)
+            finally:
+                self._queue.task_done()
+
+    def _upload(self, key, size):
+        path = self.path(key)
+        content_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+        attempt = 0
+        while not self._stopping.is_set():
+            try:
+                self.remote.save_file(key, path, content_type)
+            except FileNotFoundError:
+                # 文件已被外部删除，无法上传
+                logging.error(f"待上传的文件不存在: {key}")
+                break
+            except Exception as e:
+                attempt += 1
+                self.retries += 1
+                UPSTREAM_ERRORS.inc(upstream="s3", type=type(e).__name__)
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+                logging.warning(f"后台上传 {key} 失败(第 {attempt} 次)，{delay:.1f} 秒后重试: {str(e)}")
+                self._stopping.wait(delay)
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # 多进程共用目录时可能已被其他进程上传并删除
+                pass
+            break
+        else:
+            # 进程退出时仍未上传的文件留在本地，下次启动时重新排队
+            return
+        with self._lock:
+            self.uploaded += 1
+            self.spool_bytes -= size
+
+    def stats(self):
+        with self._lock:
+            spool_bytes = self.spool_bytes
+        return {
+            # 包含正在上传的文件
+            "pending": self._queue.unfinished_tasks,
+            "spool_bytes": spool_bytes,
+            "uploaded": self.uploaded,
+            "retries": self.retries,
+            "bypassed": self.bypassed,
+        }
+
+    def close(self, timeout=10):
+        """
+        最多等待 timeout 秒上传剩余文件，未完成的文件留在本地，下次启动时继续上传
+        """
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self._stopping.set()
+        for worker in self._workers:
+            worker.join(timeout=max(0.0, deadline - time.monotonic()) + 1)
+
+
+def create_storage(s3_client=None, max_pool_connections=8, multipart_threshold=8 * 1024 * 1024):
+    """
+    按 STORAGE_BACKEND 创建存储：s3(默认) / local / write_back
+
+    只有 s3 与 write_back 需要 S3_* 环境变量
+    """
+    backend = os.getenv("STORAGE_BACKEND", "s3").lower()
+    local_dir = os.getenv("STORAGE_LOCAL_DIR", "data/images")
+    public_url = os.getenv("STORAGE_PUBLIC_URL") or f"{os.getenv('LOCAL_SERVER_URL', 'http://127.0.0.1:11002')}/files"
+
+    if backend == "local":
+        return LocalStorage(local_dir, public_url)
+
+    remote = S3Storage(s3_client, max_pool_connections, multipart_threshold)
+    if backend == "s3":
+        return remote
+    if backend == "write_back":
+        return WriteBackStorage(
+            remote,
+            local_dir,
+            public_url,
+            spool_max_bytes=int(os.getenv("WRITE_BACK_SPOOL_MAX_BYTES", 1024 * 1024 * 1024)),
+            workers=int(os.getenv("WRITE_BACK_WORKERS", 2)),
+            return_remote_url=os.getenv("WRITE_BACK_RETURN_REMOTE_URL", "false").lower() == "true"
+        )
+    raise EnvironmentError(f"不支持的 STORAGE_BACKEND: {backend}")
@@ -0,0 +1,105 @@
+import base64
+import threading
+
+
+def decoded_size(b64_string):
+    """
+    根据 base64 字符串长度计算解码后的字节数，无需真正解码
+    """
+    padding = 0
+    if b64_string.endswith("=="):
+        padding = 2
+    elif b64_string.endswith("="):
+        padding = 1
+    return len(b64_string) // 4 * 3 - padding
+
+
+class Base64DecodeStream:
+    """
+    按需解码 base64 字符串的只读文件对象
+
+    每次 read 只解码所需的一段，作为上传请求体时不会在内存中生成完整的解码副本
+    """
+
+    def __init__(self, b64_string):
+        self._source = b64_string
+        self._position = 0
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._buffer + base64.b64decode(self._source[self._position:])
+            self._position = len(self._source)
+            self._buffer = b""
+            return data
+
+        while len(self._buffer) < size and self._position < len(self._source):
+            # 每 4 个 base64 字符对应 3 个字节，按 4 的倍数切片保证可以独立解码
+            chars = max(4, (size - len(self._buffer) + 2) // 3 * 4)
+            chunk = self._source[self._position:self._position + chars]
+            self._position += len(chunk)
+            self._buffer += base64.b64decode(chunk)
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self._source = ""
+        self._buffer = b""
+
+
+class UploadStats:
+    """
+    上传阶段的统计信息：排队数、进行中数量、完成/失败次数与耗时
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.in_progress = 0
+        self.completed = 0
+        self.failed = 0
+        self.bytes_uploaded = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def on_queued(self):
+        with self._lock:
+            self.queued += 1
+
+    def on_started(self):
+        with self._lock:
+            self.queued -= 1
+            self.in_progress += 1
+
+    def on_finished(self, seconds, size=0, success=True):
+        with self._lock:
+            self.in_progress -= 1
+            if success:
+                self.completed += 1
+                self.bytes_uploaded += size
+            else:
+                self.failed += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def on_cancelled(self):
+        # 还在排队时就被取消的上传
+        with self._lock:
+            self.queued -= 1
+
+    def snapshot(self):
+        with self._lock:
+            finished = self.completed + self.failed
+            return {
+                "queued": self.queued,
+                "in_progress": self.in_progress,
+                "completed": self.completed,
+                "failed": self.failed,
+                "bytes_uploaded": self.bytes_uploaded,
+                "avg_seconds": self.total_seconds / finished if finished else 0.0,
+                "max_seconds": self.max_seconds,
+            }
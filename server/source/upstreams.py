@@ -0,0 +1,449 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from together import Together
+from source.limiter import UpstreamLimiter, UpstreamBusyError, parse_retry_after
+from source.context import DeadlineExceededError, check_deadline, remaining_time
+from source.metrics import STAGE_DURATION, UPSTREAM_ERRORS, UPSTREAM_FAILOVERS
+
+
+class CircuitBreaker:
+    """
+    单个上游的熔断器
+
+    - closed: 正常放行，连续失败 failure_threshold 次，或最近 window 次调用的失败率达到 failure_rate 时进入 open
+    - open: 拒绝所有请求，reset_timeout 秒后进入 half_open
+    - half_open: 最多放行 half_open_max 个探测请求，成功则恢复 closed，失败则重新 open，
+      连续打开时 reset_timeout 逐次翻倍，最长 max_reset_timeout 秒
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, half_open_max=1, max_reset_timeout=300,
+                 failure_rate=0.5, window=20):
+        self.failure_threshold = failure_threshold
+        self.failure_rate = failure_rate
+        # 最近调用的结果，True 表示失败；调用数不足一半窗口时不按失败率判断
+        self.outcomes = deque(maxlen=window)
+        self.reset_timeout = reset_timeout
+        self.half_open_max = half_open_max
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_until = 0.0
+        self.probes = 0
+        self._trips = 0
+
+    def refresh(self):
+        if self.state == self.OPEN and time.monotonic() >= self.opened_until:
+            self.state = self.HALF_OPEN
+            self.probes = 0
+
+    def available(self):
+        """当前是否可以放行一个请求，不占用探测名额"""
+        self.refresh()
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN:
+            return self.probes < self.half_open_max
+        return False
+
+    def retry_after(self):
+        """距离进入 half_open 的秒数"""
+        return max(0.0, self.opened_until - time.monotonic())
+
+    def on_start(self):
+        if self.state == self.HALF_OPEN:
+            self.probes += 1
+
+    def on_success(self):
+        if self.state == self.HALF_OPEN:
+            logging.info("上游探测成功，熔断器恢复")
+            self.outcomes.clear()
+            self._trips = 0
+        self.outcomes.append(False)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probes = 0
+
+    def _failure_rate_exceeded(self):
+        if len(self.outcomes) < max(1, self.outcomes.maxlen // 2):
+            return False
+        return sum(self.outcomes) / len(self.outcomes) >= self.failure_rate
+
+    def on_failure(self):
+        """记录一次失败，熔断时返回打开的秒数"""
+        self.failures += 1
+        self.outcomes.append(True)
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold or self._failure_rate_exceeded():
+            self._trips += 1
+            timeout = min(self.max_reset_timeout, self.reset_timeout * (2 ** (self._trips - 1)))
+            self.state = self.OPEN
+            self.opened_until = time.monotonic() + timeout
+            self.failures = 0
+            self.probes = 0
+            self.outcomes.clear()
+            return timeout
+        return None
+
+    def on_release(self):
+        """请求没有得出上游是否健康的结论(被取消、被限流或请求本身有误)时归还探测名额"""
+        if self.state == self.HALF_OPEN and self.probes > 0:
+            self.probes -= 1
+
+
+class Upstream:
+    """
+    一个上游：一个 API Key 与一个服务地址，拥有独立的限流器和熔断器
+    """
+
+    def __init__(self, name, client, models=None, weight=1.0, model_map=None, limits=None, breaker=None):
+        """
+        参数:
+            name (str): 上游名称，用于日志和指标
+            client: Together 兼容的客户端
+            models (list): 支持的模型，为空时支持所有模型
+            weight (float): 权重，越大分到的请求越多
+            model_map (dict): 模型名称映射，上游使用不同的模型ID时配置
+            limits (dict): 覆盖该上游的默认限流参数，例如 {"rate": 1, "concurrency": 4}
+        """
+        self.name = name
+        self.client = client
+        self.models = set(models) if models else None
+        self.weight = max(0.01, float(weight))
+        self.model_map = model_map or {}
+        self.limiter = UpstreamLimiter(defaults=limits)
+        self.breaker = breaker or CircuitBreaker()
+        self.outstanding = 0
+        self.calls = 0
+        self.failures = 0
+        # 按模型记录的耗时指数移动平均(秒)
+        self.latency = {}
+
+    def supports(self, model):
+        return self.models is None or model in self.models
+
+    def observe_latency(self, model, seconds, alpha=0.2):
+        previous = self.latency.get(model)
+        self.latency[model] = seconds if previous is None else previous + alpha * (seconds - previous)
+
+
+class UpstreamPool:
+    """
+    多个上游组成的池，按负载选择上游，失败时自动切换到其他健康的上游
+
+    选择策略(UPSTREAM_SELECTION):
+    - least_outstanding: 进行中请求数(含排队)除以权重最小的上游
+    - latency: 进行中请求数乘以该模型的平均耗时最小的上游，没有耗时数据的上游优先尝试
+    """
+
+    def __init__(self, upstreams, run_blocking, selection="least_outstanding", max_attempts=3, cooldown=10):
+        """
+        参数:
+            upstreams (list): Upstream 列表
+            run_blocking (callable): 在线程池中执行同步调用的协程函数
+            selection (str): least_outstanding / latency
+            max_attempts (int): 单次调用最多尝试的上游数量
+            cooldown (float): 上游返回 429 且没有 Retry-After 时暂停该上游的秒数
+        """
+        if not upstreams:
+            raise ValueError("至少需要配置一个上游")
+        self.upstreams = upstreams
+        self.run_blocking = run_blocking
+        self.selection = selection
+        self.max_attempts = max(1, max_attempts)
+        self.cooldown = cooldown
+
+    @classmethod
+    def from_env(cls, run_blocking, client=None):
+        """
+        按环境变量创建上游池
+
+        - TOGETHER_UPSTREAMS: JSON 列表，每项包含 name、api_key(或 api_key_env)、base_url、models、weight、model_map、limits
+        - TOGETHER_API_KEYS: 逗号分隔的多个 API Key，使用默认服务地址
+        - 都未配置时只使用 TOGETHER_API_KEY
+
+        SDK 自身的重试(TOGETHER_MAX_RETRIES)在只有一个上游时默认 2 次，多个上游时默认不重试，直接切换上游
+
+        参数:
+            client: 传入时只使用这个客户端(或客户端列表)，压测时可以传入本地替身
+        """
+        breaker_config = {
+            "failure_threshold": int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5)),
+            "reset_timeout": float(os.getenv("BREAKER_RESET_TIMEOUT", 30)),
+            "half_open_max": int(os.getenv("BREAKER_HALF_OPEN_MAX", 1)),
+            "max_reset_timeout": float(os.getenv("BREAKER_MAX_RESET_TIMEOUT", 300)),
+            "failure_rate": float(os.getenv("BREAKER_FAILURE_RATE", 0.5)),
+            "window": int(os.getenv("BREAKER_WINDOW", 20)),
+        }
+        upstreams = []
+        if client is not None:
+            clients = client if isinstance(client, (list, tuple)) else [client]
+            for i, item in enumerate(clients):
+                name = "default" if len(clients) == 1 else f"upstream-{i}"
+                upstreams.append(Upstream(name, item, breaker=CircuitBreaker(**breaker_config)))
+        elif os.getenv("TOGETHER_UPSTREAMS"):
+            configs = json.loads(os.getenv("TOGETHER_UPSTREAMS"))
+            max_retries = int(os.getenv("TOGETHER_MAX_RETRIES") or (2 if len(configs) == 1 else 0))
+            for i, config in enumerate(configs):
+                api_key = config.get("api_key") or os.getenv(config.get("api_key_env", ""), "")
+                if not api_key:
+                    raise EnvironmentError(f"TOGETHER_UPSTREAMS 第 {i + 1} 项缺少 api_key")
+                upstreams.append(Upstream(
+                    config.get("name", f"upstream-{i}"),
+                    Together(api_key=api_key, base_url=config.get("base_url"), max_retries=max_retries),
+                    models=config.get("models"),
+                    weight=config.get("weight", 1.0),
+                    model_map=config.get("model_map"),
+                    limits=config.get("limits"),
+                    breaker=CircuitBreaker(**breaker_config)
+                ))
+        else:
+            api_keys = [key.strip() for key in os.getenv("TOGETHER_API_KEYS", "").split(",") if key.strip()]
+            api_keys = api_keys or [os.getenv("TOGETHER_API_KEY")]
+            max_retries = int(os.getenv("TOGETHER_MAX_RETRIES") or (2 if len(api_keys) == 1 else 0))
+            for i, api_key in enumerate(api_keys):
+                name = "default" if len(api_keys) == 1 else f"key-{i}"
+                upstreams.append(Upstream(
+                    name,
+                    Together(api_key=api_key, max_retries=max_retries),
+                    breaker=CircuitBreaker(**breaker_config)
+                ))
+
+        return cls(
+            upstreams,
+            run_blocking,
+            selection=os.getenv("UPSTREAM_SELECTION", "least_outstanding"),
+            max_attempts=int(os.getenv("UPSTREAM_FAILOVER_ATTEMPTS", 3)),
+            cooldown=float(os.getenv("UPSTREAM_COOLDOWN", 10))
+        )
+
+    def _score(self, upstream, model):
+        if self.selection == "latency":
+            latency = upstream.latency.get(model)
+            if latency is None:
+                return 0.0
+            return (upstream.outstanding + 1) * latency / upstream.weight
+        return upstream.outstanding / upstream.weight
+
+    def select(self, model, exclude=(), avoid=()):
+        """
+        选择一个可用的上游，没有时返回 None
+
+        参数:
+            model (str): 模型名称
+            exclude (iterable): 不参与选择的上游，例如本次调用已经失败过的上游
+            avoid (iterable): 尽量不选的上游，例如对冲请求避开正常请求所在的上游
+        """
+        candidates = [
+            upstream for upstream in self.upstreams
+            if upstream not in exclude and upstream.supports(model) and upstream.breaker.available()
+        ]
+        if not candidates:
+            return None
+        # 刚被限流而暂停的上游排在最后；得分相同时随机选择，避免总是压在第一个上游
+        return min(candidates, key=lambda upstream: (
+            upstream.limiter.for_model(model).bucket.paused_for() > 0,
+            upstream in avoid,
+            self._score(upstream, model),
+            random.random()
+        ))
+
+    def _unavailable_error(self, model):
+        supporting = [upstream for upstream in self.upstreams if upstream.supports(model)]
+        if not supporting:
+            return ValueError(f"没有支持模型 {model} 的上游")
+        retry_after = min(upstream.breaker.retry_after() for upstream in supporting)
+        return UpstreamBusyError(f"模型 {model} 的所有上游均已熔断", retry_after=retry_after)
+
+    async def call(self, upstream_model, operation, used=None, on_dispatch=None, **kwargs):
+        """
+        调用 client.images.<operation>，失败或被限流时换一个上游重试
+
+        请求本身有误(4xx)时不切换上游，直接抛出；所有上游都被限流时抛出 UpstreamBusyError；
+        当前请求超过截止时间时不再切换上游，抛出 DeadlineExceededError
+
+        参数:
+            upstream_model (str): 模型名称
+            operation (str): images 上的方法名，目前只有 generate
+            used (list): 记录本次选择的上游；多次调用共用同一个列表时后面的调用会尽量避开这些上游
+            on_dispatch (callable): 拿到上游并发名额和限流令牌、真正发出调用时回调，切换上游重试时会再次回调
+            **kwargs: 传递给上游的参数
+
+        返回:
+            上游的响应
+        """
+        tried = []
+        avoid = list(used) if used is not None else ()
+        last_error = None
+        while len(tried) < self.max_attempts:
+            check_deadline()
+            upstream = self.select(upstream_model, exclude=tried, avoid=avoid)
+            if upstream is None:
+                break
+            if tried:
+                UPSTREAM_FAILOVERS.inc(model=upstream_model)
+                logging.warning(f"切换到上游 {upstream.name} 重试模型 {upstream_model}: {str(last_error)}")
+            tried.append(upstream)
+            if used is not None:
+                used.append(upstream)
+            try:
+                return await self.call_upstream(upstream, upstream_model, operation, on_dispatch, **kwargs)
+            except (UpstreamBusyError, UpstreamFailure) as e:
+                last_error = e
+        if last_error is None:
+            raise self._unavailable_error(upstream_model)
+        if isinstance(last_error, UpstreamFailure):
+            raise last_error.error
+        raise last_error
+
+    async def call_upstream(self, upstream, upstream_model, operation, on_dispatch=None, **kwargs):
+        """
+        在指定上游上调用一次，拿到并发名额和限流令牌后回调 on_dispatch
+
+        被限流或排队超时时抛出 UpstreamBusyError，上游故障时抛出包装原始异常的 UpstreamFailure，
+        请求本身有误时抛出原始异常
+        """
+        func = getattr(upstream.client.images, operation)
+        kwargs["model"] = upstream.model_map.get(upstream_model, upstream_model)
+        upstream.outstanding += 1
+        upstream.breaker.on_start()
+        concluded = False
+        try:
+            async with upstream.limiter.for_model(upstream_model).slot():
+                # 排队期间可能已经超过截止时间；否则上游调用的超时不超过剩余时间
+                check_deadline()
+                remaining = remaining_time()
+                if remaining is not None:
+                    kwargs["timeout"] = remaining
+                upstream.calls += 1
+                if on_dispatch is not None:
+                    on_dispatch()
+                started_at = time.perf_counter()
+                try:
+                    with STAGE_DURATION.time(stage="generate"):
+                        response = await self._run_to_completion(self.run_blocking(func, **kwargs))
+                except Exception as e:
+                    if remaining is not None and remaining_time() <= 0:
+                        # 按请求剩余时间设置的超时到期，不代表上游故障，不计入熔断
+                        raise DeadlineExceededError(f"调用上游 {upstream.name} 时超过请求截止时间: {str(e)}")
+                    rate_limited = _is_rate_limit_error(e)
+                    UPSTREAM_ERRORS.inc(upstream=f"together:{upstream.name}", type="rate_limited" if rate_limited else type(e).__name__)
+                    if rate_limited:
+                        retry_after = parse_retry_after(_error_header(e, "Retry-After")) or self.cooldown
+                        upstream.limiter.penalize(upstream_model, retry_after)
+                        raise UpstreamBusyError(f"模型 {upstream_model} 被上游 {upstream.name} 限流: {str(e)}", retry_after=retry_after)
+                    if _is_client_error(e):
+                        # 请求本身有误，上游是健康的
+                        upstream.breaker.on_success()
+                        concluded = True
+                        raise
+                    upstream.failures += 1
+                    opened = upstream.breaker.on_failure()
+                    concluded = True
+                    if opened:
+                        logging.error(f"上游 {upstream.name} 熔断 {opened:.0f} 秒: {str(e)}")
+                    raise UpstreamFailure(upstream, e)
+                upstream.observe_latency(upstream_model, time.perf_counter() - started_at)
+                upstream.breaker.on_success()
+                concluded = True
+                return response
+        finally:
+            upstream.outstanding -= 1
+            if not concluded:
+                upstream.breaker.on_release()
+
+    async def _run_to_completion(self, coroutine):
+        """
+        等待线程池中的同步调用；调用方被取消时仍等到线程中的调用结束再退出，
+        保证限流器的并发名额与实际进行中的上游调用一致
+        """
+        future = asyncio.ensure_future(coroutine)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            try:
+                await future
+            except Exception:
+                pass
+            raise
+
+    def latency(self, model):
+        """支持该模型的上游最近耗时(秒)的平均值，没有记录时返回 None"""
+        values = [upstream.latency[model] for upstream in self.upstreams if model in upstream.latency]
+        return sum(values) / len(values) if values else None
+
+    def capacity(self, model):
+        """支持该模型的上游对该模型的并发数之和，包括 UPSTREAM_LIMITS 中按模型的覆盖"""
+        return sum(
+            upstream.limiter.for_model(model).concurrency for upstream in self.upstreams if upstream.supports(model)
+        )
+
+    def limiter_stats(self):
+        """按模型汇总所有上游的排队数与进行中的调用数"""
+        totals = {}
+        for upstream in self.upstreams:
+            for model, stats in upstream.limiter.stats().items():
+                total = totals.setdefault(model, {"waiting": 0, "active": 0})
+                total["waiting"] += stats["waiting"]
+                total["active"] += stats["active"]
+        return totals
+
+    def stats(self):
+        for upstream in self.upstreams:
+            upstream.breaker.refresh()
+        return {
+            upstream.name: {
+                "state": upstream.breaker.state,
+                "outstanding": upstream.outstanding,
+                "calls": upstream.calls,
+                "failures": upstream.failures,
+                "latency": {model: round(seconds, 3) for model, seconds in upstream.latency.items()},
+            }
+            for upstream in self.upstreams
+        }
+
+
+class UpstreamFailure(Exception):
+    """上游故障(5xx、超时、连接失败等)，可以换一个上游重试"""
+
+    def __init__(self, upstream, error):
+        super().__init__(str(error))
+        self.upstream = upstream
+        self.error = error
+
+
+def _status_code(error):
+    return getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+
+
+def _is_rate_limit_error(error):
+    """判断 Together SDK 抛出的异常是否为 429 限流"""
+    if type(error).__name__ == "RateLimitError":
+        return True
+    return _status_code(error) == 429
+
+
+def _error_header(error, name):
+    headers = getattr(getattr(error, "response", None), "headers", None) or getattr(error, "headers", None)
+    if not headers:
+        return None
+    return headers.get(name)
+
+
+def _is_client_error(error):
+    """
+    请求参数错误、内容审核等 4xx 错误，换上游也不会成功
+
+    401 / 403 通常是某个 API Key 失效，按上游故障处理
+    """
+    if isinstance(error, (TypeError, ValueError)):
+        return True
+    status_code = _status_code(error)
+    return isinstance(status_code, int) and 400 <= status_code < 500 and status_code not in (401, 403, 408, 429)
@@ -0,0 +1,90 @@
+import io
+import base64
+import logging
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    # 较旧版本的 Pillow 需要该插件才能编码 AVIF
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+# 格式名称 -> (Pillow 格式, 扩展名, Content-Type)
+VARIANT_FORMATS = {
+    "webp": ("WEBP", "webp", "image/webp"),
+    "avif": ("AVIF", "avif", "image/avif"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+}
+
+
+def supported_formats(formats):
+    """
+    过滤出当前环境可以编码的格式，未安装 Pillow 或缺少编码器时记录警告
+
+    参数:
+        formats (list): 需要的格式名称，例如 ["webp", "avif"]
+
+    返回:
+        list: 可用的格式名称
+    """
+    if not formats:
+        return []
+    if Image is None:
+        logging.warning("未安装 Pillow，不生成图片变体")
+        return []
+    Image.init()
+    available = []
+    for name in formats:
+        if name not in VARIANT_FORMATS:
+            logging.warning(f"不支持的图片格式: {name}")
+        elif VARIANT_FORMATS[name][0] not in Image.SAVE:
+            logging.warning(f"当前 Pillow 不支持编码 {name}，已跳过")
+        else:
+            available.append(name)
+    return available
+
+
+def _encode(image, name, quality):
+    pillow_format = VARIANT_FORMATS[name][0]
+    if pillow_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format=pillow_format, quality=quality)
+    return buffer.getvalue()
+
+
+def encode_variants(b64_string, formats, thumbnail_sizes, thumbnail_format="webp", quality=80):
+    """
+    将 base64 编码的原图转码为其他格式并生成缩略图，在进程池中执行
+
+    参数:
+        b64_string (str): base64 编码的原图
+        formats (list): 原尺寸转码的格式名称
+        thumbnail_sizes (list): 缩略图最长边的像素数，缩略图保持宽高比
+        thumbnail_format (str): 缩略图的格式名称，为 None 时不生成缩略图
+        quality (int): 有损编码的质量
+
+    返回:
+        list: (变体名称, 扩展名, Content-Type, 图片数据)，变体名称如 "webp"、"thumb_256"
+    """
+    image = Image.open(io.BytesIO(base64.b64decode(b64_string)))
+    image.load()
+
+    variants = []
+    for name in formats:
+        _, extension, content_type = VARIANT_FORMATS[name]
+        variants.append((name, extension, content_type, _encode(image, name, quality)))
+
+    # 没有配置缩略图时 thumbnail_format 为 None
+    if not thumbnail_sizes or not thumbnail_format:
+        return variants
+    _, extension, content_type = VARIANT_FORMATS[thumbnail_format]
+    for size in thumbnail_sizes:
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size), Image.LANCZOS)
+        variants.append((f"thumb_{size}", extension, content_type, _encode(thumbnail, thumbnail_format, quality)))
+    return variants
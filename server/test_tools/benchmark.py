@@ -0,0 +1,533 @@
+"""
+离线压测工具
+
+在进程内启动 FastAPI 应用，并用本地替身代替所有外部依赖：
+- Together: 可配置延迟与 429 比例，返回预先生成的 base64 PNG
+- S3: 内存中的对象存储
+- Azure OpenAI: 本地 HTTP 服务，可注入 429 / 5xx / content_filter 错误
+
+不需要网络和任何配额，可以在相同条件下对比每一次性能改动
+"""
+import io
+import os
+import re
+import sys
+import json
+import base64
+import time
+import zlib
+import types
+import random
+import struct
+import asyncio
+import argparse
+import shutil
+import resource
+import threading
+import tempfile
+import tracemalloc
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 添加项目根目录到 Python 路径，以便导入项目模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_png(size_kb):
+    """
+    生成一张约 size_kb KB 的 PNG 图片，像素随机，压缩后大小与原始数据接近
+    """
+    width = 512
+    height = max(1, size_kb * 1024 // (width * 3))
+    rng = random.Random(0)
+    raw = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 0))
+        + chunk(b"IEND", b"")
+    )
+
+
+class FakeRateLimitError(Exception):
+    """模拟 Together SDK 的 429 错误"""
+
+    def __init__(self, retry_after):
+        super().__init__("Rate limit exceeded")
+        self.status_code = 429
+        self.headers = {"retry-after": str(retry_after)}
+
+
+class FakeServerError(Exception):
+    """模拟 Together SDK 的 500 错误"""
+
+    def __init__(self):
+        super().__init__("Internal server error")
+        self.status_code = 500
+
+
+class FakeTogetherImages:
+    def __init__(self, b64_image, latency, jitter, rate_limit_ratio, error_ratio=0.0, slow_ratio=0.0):
+        self.b64_image = b64_image
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.error_ratio = error_ratio
+        self.slow_ratio = slow_ratio
+        self.calls = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    # 与 Together SDK 2.x 的 images.generate 接受的参数一致，传入 SDK 不支持的参数时同样抛出 TypeError
+    SUPPORTED_PARAMS = {
+        "model", "prompt", "disable_safety_checker", "guidance_scale", "height", "image_loras", "image_url",
+        "n", "negative_prompt", "output_format", "reference_images", "response_format", "seed", "steps", "width",
+        "extra_headers", "extra_query", "extra_body", "timeout",
+    }
+
+    def generate(self, **kwargs):
+        unsupported = set(kwargs) - self.SUPPORTED_PARAMS
+        if unsupported:
+            raise TypeError(f"generate() got unexpected keyword arguments: {', '.join(sorted(unsupported))}")
+        with self._lock:
+            self.calls += 1
+        if random.random() < self.rate_limit_ratio:
+            with self._lock:
+                self.rate_limited += 1
+            raise FakeRateLimitError(retry_after=1)
+        if random.random() < self.error_ratio:
+            with self._lock:
+                self.errors += 1
+            # 故障的上游通常在较短时间内返回错误
+            time.sleep(self.latency / 10)
+            raise FakeServerError()
+        latency = max(0.0, random.gauss(self.latency, self.jitter))
+        # 耗时与步数和像素数成正比，4 步 1024x1024 为 --together_latency，用于观察降低生成质量的效果
+        if kwargs.get("steps"):
+            latency *= kwargs["steps"] / 4
+        if kwargs.get("width") and kwargs.get("height"):
+            latency *= kwargs["width"] * kwargs["height"] / (1024 * 1024)
+        if random.random() < self.slow_ratio:
+            # 偶发的慢调用，决定了尾延迟
+            latency *= 10
+        time.sleep(latency)
+        return types.SimpleNamespace(data=[types.SimpleNamespace(b64_json=self.b64_image)])
+
+
+class FakeTogether:
+    """Together 客户端替身，images.generate 按配置的延迟返回固定图片"""
+
+    def __init__(self, b64_image, latency=3.0, jitter=0.5, rate_limit_ratio=0.0, error_ratio=0.0, slow_ratio=0.0):
+        self.images = FakeTogetherImages(b64_image, latency, jitter, rate_limit_ratio, error_ratio, slow_ratio)
+
+
+class InMemoryS3:
+    """S3 客户端替身，对象保存在内存中，只记录大小以免压测本身占用过多内存"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def _store(self, key, size):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.objects[key] = size
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._store(Key, len(Body.read() if hasattr(Body, "read") else Body))
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None):
+        size = 0
+        while True:
+            data = Fileobj.read(1024 * 1024)
+            if not data:
+                break
+            size += len(data)
+        self._store(Key, size)
+
+    def stats(self):
+        with self._lock:
+            return {"objects": len(self.objects), "bytes": sum(self.objects.values())}
+
+
+class FakeAzureServer:
+    """
+    Azure OpenAI chat/completions 替身，运行在本地端口上
+
+    按比例返回 429(带 Retry-After)、500 和 content_filter 错误，其余请求在 latency 秒后返回优化后的提示词
+    """
+
+    def __init__(self, latency=1.0, rate_limit_ratio=0.0, server_error_ratio=0.0, content_filter_ratio=0.0):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.server_error_ratio = server_error_ratio
+        self.content_filter_ratio = content_filter_ratio
+        self.counts = {"ok": 0, "429": 0, "500": 0, "content_filter": 0}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # 使用 HTTP/1.1 以便客户端复用长连接
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, payload, headers=None):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                roll = random.random()
+                if roll < fake.rate_limit_ratio:
+                    fake._count("429")
+                    return self._reply(429, {"error": {"code": "429"}}, {"Retry-After": "1"})
+                roll -= fake.rate_limit_ratio
+                if roll < fake.server_error_ratio:
+                    fake._count("500")
+                    return self._reply(500, {"error": {"code": "InternalServerError"}})
+                roll -= fake.server_error_ratio
+                if roll < fake.content_filter_ratio:
+                    fake._count("content_filter")
+                    return self._reply(400, {"error": {"code": "content_filter", "message": "filtered"}})
+
+                time.sleep(max(0.0, random.gauss(fake.latency, fake.latency * 0.2)))
+                fake._count("ok")
+                # 不同的输入返回不同的结果，避免相同请求合并导致上游调用次数失真；批量优化时按编号逐条返回
+                user_message = request.get("messages", [{}])[-1].get("content", "")
+                items = re.split(r"^### (\d+)\n", user_message, flags=re.MULTILINE)[1:]
+                if items:
+                    content = "\n\n".join(
+                        f"### {number}\nhighly detailed, 4k resolution, masterpiece, scene {zlib.crc32(text.strip().encode('utf-8'))}"
+                        for number, text in zip(items[::2], items[1::2])
+                    )
+                else:
+                    content = f"highly detailed, 4k resolution, masterpiece, scene {zlib.crc32(user_message.encode('utf-8'))}"
+                return self._reply(200, {
+                    "choices": [{"message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]
+                })
+
+        return Handler
+
+
+def configure_environment(args, azure_url):
+    """
+    用替身的地址覆盖外部服务配置；限流、并发等参数仍然读取当前环境变量，便于对比不同配置
+    """
+    os.environ.update({
+        "TOGETHER_API_KEY": "benchmark",
+        "TOGETHER_MODEL": args.model,
+        "S3_ENDPOINT_URL": "http://s3.benchmark.local",
+        "S3_ACCESS_KEY_ID": "benchmark",
+        "S3_SECRET_ACCESS_KEY": "benchmark",
+        "S3_BUCKET_NAME": "benchmark",
+        "AZURE_OPENAI_API_KEY": "benchmark",
+        "AZURE_OPENAI_API_BASE": azure_url,
+        "AZURE_OPENAI_API_VERSION": "2024-02-01",
+        "AZURE_OPENAI_MODEL": "benchmark",
+        # 压测时不读写缓存文件
+        "PROMPT_CACHE_PATH": "",
+        "RESULT_CACHE_PATH": "",
+        "STORAGE_BACKEND": args.storage,
+    })
+    if args.storage != "s3":
+        # 本地存储写入临时目录，压测结束后删除
+        os.environ["STORAGE_LOCAL_DIR"] = tempfile.mkdtemp(prefix="aigc-benchmark-")
+    # 默认不限制上游速率，否则吞吐量只反映 UPSTREAM_RATE 的配置
+    os.environ.setdefault("UPSTREAM_RATE", "0")
+    # 注入的错误会产生大量日志，默认只在 --verbose 时输出
+    os.environ.setdefault("LOG_LEVEL", "INFO" if args.verbose else "CRITICAL")
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(values):
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else 0.0,
+    }
+
+
+def current_rss_mb():
+    # Linux 上读取 /proc 获得当前常驻内存，其他平台返回 None
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位为 KB，macOS 上为字节
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+async def run_benchmark(args):
+    import httpx
+    from source import registry
+    from source.algorithm import ImageGenerator
+    from source.storage import create_storage
+    import main
+
+    b64_image = base64.b64encode(make_png(args.image_kb)).decode()
+    # 多个上游时只有第一个上游按 --together_5xx 返回错误，用于观察熔断与切换
+    upstreams = [
+        FakeTogether(
+            b64_image, args.together_latency, args.together_jitter, args.together_429,
+            args.together_5xx if i == 0 else 0.0, args.together_slow
+        )
+        for i in range(args.together_upstreams)
+    ]
+    s3 = InMemoryS3(args.s3_latency)
+    generator = ImageGenerator(togetherai_client=upstreams, storage=create_storage(s3_client=s3))
+    registry._image_generator = generator
+    await registry.startup()
+
+    latencies = []
+    tenant_latencies = {}
+    status_codes = {}
+    stage_timings = {"optimize": [], "generate": [], "upload": []}
+    images = 0
+    degraded = 0
+    next_request = 0
+
+    def build_payload(index, tenant):
+        # 默认每个请求使用不同的提示词并跳过结果缓存，测量的是未命中缓存时的完整链路
+        prompt = args.prompt if args.repeat_prompt else f"{args.prompt} #{index}"
+        payload = {
+            "prompt": prompt,
+            # 第一个租户按 --heavy_count 请求更多图片，用于观察公平调度
+            "count": args.heavy_count if tenant == 0 and args.heavy_count else args.count,
+            "model": args.model,
+            "needOptimizePrompt": args.optimize,
+            "noCache": not args.repeat_prompt,
+        }
+        if args.repeat_prompt:
+            # 只有指定了 seed 的请求才会使用生成结果缓存
+            payload["seed"] = args.seed
+        return payload
+
+    async def worker(client, total, record, tenant):
+        nonlocal next_request, images, degraded
+        while next_request < total:
+            index = next_request
+            next_request += 1
+            start = time.perf_counter()
+            response = await client.post(
+                "/image/generate",
+                json=build_payload(index, tenant),
+                # 模拟 nginx 转发的客户端地址，每个地址是一个租户
+                headers={"X-Real-IP": f"10.0.0.{tenant}"}
+            )
+            elapsed = time.perf_counter() - start
+            if not record:
+                continue
+            latencies.append(elapsed)
+            tenant_latencies.setdefault(tenant, []).append(elapsed)
+            status_codes[response.status_code] = status_codes.get(response.status_code, 0) + 1
+            if response.status_code == 200:
+                body = response.json()
+                images += len(body.get("data") or [])
+                if body.get("quality"):
+                    degraded += 1
+                timings = body.get("timings") or {}
+                if "optimize" in timings:
+                    stage_timings["optimize"].append(timings["optimize"] / 1000)
+                for image in timings.get("images", []):
+                    for stage in ("generate", "upload"):
+                        if stage in image:
+                            stage_timings[stage].append(image[stage] / 1000)
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        if args.warmup:
+            await asyncio.gather(*(worker(client, args.warmup, False, i % args.tenants) for i in range(min(args.warmup, args.concurrency))))
+            next_request = 0
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        rss_before = current_rss_mb()
+        started_at = time.perf_counter()
+        await asyncio.gather(*(worker(client, args.requests, True, i % args.tenants) for i in range(args.concurrency)))
+        duration = time.perf_counter() - started_at
+        rss_after = current_rss_mb()
+        traced_peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024 if args.tracemalloc else None
+        if args.tracemalloc:
+            tracemalloc.stop()
+
+    await registry.shutdown()
+
+    report = {
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "count": args.count,
+            "optimize": args.optimize,
+            "image_kb": args.image_kb,
+            "storage": args.storage,
+            "together_latency": args.together_latency,
+            "together_upstreams": args.together_upstreams,
+            "tenants": args.tenants,
+            "heavy_count": args.heavy_count,
+            "azure_latency": args.azure_latency,
+        },
+        "duration_seconds": duration,
+        "throughput": {
+            "requests_per_second": len(latencies) / duration if duration else 0.0,
+            "images_per_second": images / duration if duration else 0.0,
+        },
+        "latency_seconds": summarize(latencies),
+        "tenant_latency_seconds": {f"10.0.0.{tenant}": summarize(values) for tenant, values in sorted(tenant_latencies.items())},
+        "stage_seconds": {stage: summarize(values) for stage, values in stage_timings.items() if values},
+        "status_codes": status_codes,
+        "degraded_requests": degraded,
+        "memory_mb": {
+            "rss_before": rss_before,
+            "rss_after": rss_after,
+            "peak_rss": peak_rss_mb(),
+            "tracemalloc_peak": traced_peak,
+        },
+        "upstream": {
+            "together_calls": sum(together.images.calls for together in upstreams),
+            "together_429": sum(together.images.rate_limited for together in upstreams),
+            "together_5xx": sum(together.images.errors for together in upstreams),
+            "together_pool": generator.upstream_pool.stats(),
+            "hedges": generator.hedger.stats(),
+            "s3": s3.stats(),
+        },
+    }
+    return report
+
+
+def print_report(report, azure_counts):
+    config = report["config"]
+    print(f"请求数: {config['requests']}  并发: {config['concurrency']}  每次图片数: {config['count']}  "
+          f"优化提示词: {config['optimize']}  图片大小: {config['image_kb']} KB  存储: {config['storage']}")
+    print(f"总耗时: {report['duration_seconds']:.2f} 秒")
+    print(f"吞吐量: {report['throughput']['requests_per_second']:.2f} 请求/秒, "
+          f"{report['throughput']['images_per_second']:.2f} 图片/秒")
+    latency = report["latency_seconds"]
+    print(f"请求延迟: p50 {latency['p50']:.3f}s  p95 {latency['p95']:.3f}s  p99 {latency['p99']:.3f}s  max {latency['max']:.3f}s")
+    if len(report["tenant_latency_seconds"]) > 1:
+        for tenant, values in report["tenant_latency_seconds"].items():
+            print(f"  租户 {tenant:<10} p50 {values['p50']:.3f}s  p95 {values['p95']:.3f}s")
+    for stage, values in report["stage_seconds"].items():
+        print(f"  {stage:<9} p50 {values['p50']:.3f}s  p95 {values['p95']:.3f}s  p99 {values['p99']:.3f}s")
+    print(f"状态码: {report['status_codes']}")
+    if report["degraded_requests"]:
+        print(f"降低生成质量的请求: {report['degraded_requests']} 个")
+    memory = report["memory_mb"]
+    line = f"内存: 峰值 RSS {memory['peak_rss']:.1f} MB"
+    if memory["rss_before"] is not None:
+        line += f", 压测前 {memory['rss_before']:.1f} MB, 压测后 {memory['rss_after']:.1f} MB"
+    if memory["tracemalloc_peak"] is not None:
+        line += f", Python 分配峰值 {memory['tracemalloc_peak']:.1f} MB"
+    print(line)
+    upstream = report["upstream"]
+    print(f"上游: Together 调用 {upstream['together_calls']} 次(429 {upstream['together_429']} 次, "
+          f"500 {upstream['together_5xx']} 次), S3 对象 {upstream['s3']['objects']} 个, Azure {azure_counts}")
+    if upstream["hedges"]["fired"]:
+        print(f"  对冲请求 {upstream['hedges']['fired']} 次, 其中先返回 {upstream['hedges']['won']} 次")
+    if len(upstream["together_pool"]) > 1:
+        for name, stats in upstream["together_pool"].items():
+            print(f"  {name}: 调用 {stats['calls']} 次, 失败 {stats['failures']} 次, 熔断器 {stats['state']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线压测文本生成图像API，所有外部服务均使用本地替身")
+
+    parser.add_argument("--requests", type=int, default=100, help="统计的请求总数")
+    parser.add_argument("--concurrency", type=int, default=10, help="同时发送请求的数量")
+    parser.add_argument("--count", type=int, default=1, help="每个请求生成的图像数量")
+    parser.add_argument("--warmup", type=int, default=0, help="正式统计前的预热请求数")
+    parser.add_argument("--prompt", type=str, default="一只可爱的猫咪在草地上玩耍", help="生成图像的文本提示词")
+    parser.add_argument("--repeat_prompt", action="store_true", help="所有请求使用相同的提示词和 --seed，允许命中缓存")
+    parser.add_argument("--seed", type=int, default=42, help="--repeat_prompt 时使用的固定种子")
+    parser.add_argument("--no_optimize", dest="optimize", action="store_false", help="不调用提示词优化")
+    parser.add_argument("--model", type=str, default="black-forest-labs/FLUX.1-schnell-Free", help="使用的模型名称")
+    parser.add_argument("--image_kb", type=int, default=1500, help="返回图片的大小(KB)")
+    parser.add_argument("--together_latency", type=float, default=3.0, help="Together 生成一张图片的平均耗时(秒)")
+    parser.add_argument("--together_jitter", type=float, default=0.5, help="Together 耗时的标准差(秒)")
+    parser.add_argument("--together_429", type=float, default=0.0, help="Together 返回 429 的比例")
+    parser.add_argument("--together_5xx", type=float, default=0.0, help="第一个 Together 上游返回 500 的比例")
+    parser.add_argument("--together_slow", type=float, default=0.0, help="Together 调用耗时变为 10 倍的比例，用于观察尾延迟与对冲请求")
+    parser.add_argument("--together_upstreams", type=int, default=1, help="Together 上游(API Key)的数量")
+    parser.add_argument("--tenants", type=int, default=1, help="并发的 worker 平均分给多少个租户(X-Real-IP)")
+    parser.add_argument("--heavy_count", type=int, default=0, help="第一个租户每个请求生成的图像数量，用于观察公平调度")
+    parser.add_argument("--storage", type=str, default="s3", choices=["s3", "local", "write_back"], help="图片存储方式，本地文件写入临时目录")
+    parser.add_argument("--s3_latency", type=float, default=0.05, help="S3 上传一张图片的耗时(秒)")
+    parser.add_argument("--azure_latency", type=float, default=1.0, help="Azure 提示词优化的平均耗时(秒)")
+    parser.add_argument("--azure_429", type=float, default=0.0, help="Azure 返回 429 的比例")
+    parser.add_argument("--azure_5xx", type=float, default=0.0, help="Azure 返回 500 的比例")
+    parser.add_argument("--azure_content_filter", type=float, default=0.0, help="Azure 返回 content_filter 的比例")
+    parser.add_argument("--tracemalloc", action="store_true", help="统计 Python 内存分配峰值(会降低吞吐量)")
+    parser.add_argument("--verbose", action="store_true", help="输出服务端的日志和打印信息")
+    parser.add_argument("--json", type=str, help="将结果以 JSON 格式写入指定文件，便于对比不同版本")
+
+    args = parser.parse_args()
+
+    azure = FakeAzureServer(args.azure_latency, args.azure_429, args.azure_5xx, args.azure_content_filter).start()
+    configure_environment(args, azure.url)
+    # 生成过程中每张图片都会打印日志，压测时默认不输出
+    output = sys.stdout if args.verbose else io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            report = asyncio.run(run_benchmark(args))
+    finally:
+        azure.stop()
+        if args.storage != "s3":
+            shutil.rmtree(os.environ["STORAGE_LOCAL_DIR"], ignore_errors=True)
+    report["upstream"]["azure"] = azure.counts
+
+    print_report(report, azure.counts)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
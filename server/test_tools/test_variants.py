@@ -0,0 +1,45 @@
+import io
+import os
+import sys
+import base64
+
+# 添加项目根目录到 Python 路径，以便导入项目模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from source.variants import encode_variants, supported_formats
+
+
+def make_png(width=64, height=48):
+    """生成一张纯色 PNG，返回 base64 字符串"""
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 120, 40)).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def check(description, formats, thumbnail_sizes, thumbnail_format, expected):
+    """
+    按 algorithm.py 中的配置方式调用 encode_variants，检查生成的变体名称
+
+    参数:
+        formats (list): IMAGE_VARIANT_FORMATS 中的格式
+        thumbnail_sizes (list): IMAGE_THUMBNAIL_SIZES 中的尺寸，未配置时为空
+        thumbnail_format (str): 缩略图格式，未配置缩略图时为 None
+        expected (list): 期望的变体名称
+    """
+    variants = encode_variants(make_png(), formats, thumbnail_sizes, thumbnail_format)
+    names = [name for name, _, _, _ in variants]
+    assert names == expected, f"{description}: 期望 {expected}，实际 {names}"
+    for name, _, _, data in variants:
+        assert data, f"{description}: 变体 {name} 为空"
+    print(f"通过: {description} -> {names}")
+
+
+if __name__ == "__main__":
+    formats = supported_formats(["webp", "jpeg"])
+    # 只配置 IMAGE_VARIANT_FORMATS、没有配置 IMAGE_THUMBNAIL_SIZES 时 thumbnail_format 为 None
+    check("只配置转码格式", formats, [], None, formats)
+    check("只配置缩略图", [], [32, 16], "jpeg", ["thumb_32", "thumb_16"])
+    check("同时配置转码格式与缩略图", formats, [32], "jpeg", formats + ["thumb_32"])
+    check("都不配置", [], [], None, [])
+    print("图片变体检查全部通过")